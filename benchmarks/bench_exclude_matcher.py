@@ -0,0 +1,101 @@
+"""
+Per-ad cost of the exclude list check: the nltk tokenization loop that
+KijijiScraper.find_ads used before, against the compiled ExcludeMatcher.
+
+Uses the longest exclude list of scraper_config.yaml and synthetic ad texts,
+and checks that both give the same decision for every ad and for EDGE_CASES.
+
+    python benchmarks/bench_exclude_matcher.py [--ads 2000]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+import nltk
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'kijiji_scraper'))
+
+from exclude_matcher import ExcludeMatcher  # noqa: E402
+from kijiji_scraper import extract_phone_numbers, extract_email_addresses  # noqa: E402
+
+WORDS = ['teak', 'danish', 'modern', 'chair', 'table', 'dresser', 'vintage', 'solid', 'wood', 'walnut',
+         'sideboard', 'credenza', 'lamp', 'mid', 'century', 'great', 'condition', 'pick', 'up', 'calgary',
+         'nw', 'sw', 'price', 'firm', 'obo', 'set', 'of', '4', 'chairs', 'legs', 'drawers', 'original']
+PUNCTUATION = ['', '', '', ',', '.', '!', '/', '-', "'s", ':', ')']
+# Punctuation after a clitic or a final period and runs of punctuation next to
+# a word, which the random ads never put together, filled with exclude words
+EDGE_CASES = ["bought at {}'s, like new", "from {}'s.", "it's {}'s!", "{}'s; great", "solid wood (not {}.)",
+              "({}'s) chair", "{}'s: great", "the {}'s... chair", "{}.", "{}'s.com chair", "{}'s:5 chair",
+              "k:,{}", "{}'.,", "a:,{} chair", ",,{}", "::{}", ",:,{}", "---{}", "--{}", "''{}", "'''{}",
+              "{}'--)", "{}'ll--", "{}'.?", "{}.» chair", "{}.»", "{}.) chair", "{}.) \"", "{}.' ] '",
+              "{}'ll'/", "{}'ll's\n", "{}n't's!", "{}n't'll chair", "{}'s's chair", "{}'s'", "{}'s' chair",
+              "{}'s'\nchair", "{}'ll'", "{}n't']"]
+
+
+def tokenize(text):
+    try:
+        return nltk.word_tokenize(text)
+    except LookupError:
+        # punkt models are not downloaded, break sentences after every period
+        return [token for sentence in re.split(r'(?<=[.!?])\s+', text)
+                for token in nltk.word_tokenize(sentence, preserve_line=True)]
+
+
+def nltk_exclude(exclude_list, full_text):
+    full_text_word_list = set(tokenize(full_text)) | set(extract_phone_numbers(full_text)) \
+                          | set(extract_email_addresses(full_text))
+    for word in exclude_list:
+        if (word.lower() in full_text_word_list) or ((len(word.split()) > 1) and word.lower() in full_text):
+            return word
+    return None
+
+
+def make_ads(exclude_list, n_ads, seed=0):
+    rnd = random.Random(seed)
+    vocabulary = WORDS + exclude_list
+    ads = []
+    for _ in range(n_ads):
+        words = [rnd.choice(WORDS if rnd.random() < 0.97 else vocabulary) + rnd.choice(PUNCTUATION)
+                 for _ in range(rnd.randint(20, 80))]
+        if rnd.random() < 0.05:
+            words.append('call 403-828-5672 or seller@example.com')
+        ads.append(' '.join(words).lower())
+    return ads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--ads', type=int, default=2000, help="Number of synthetic ads")
+    parser.add_argument('--config', default=os.path.join(ROOT, 'scraper_config.yaml'))
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        _, urls = yaml.safe_load_all(f)
+    exclude_list = max(([str(e).lower() for e in u.get('exclude', [])] for u in urls), key=len)
+    ads = make_ads(exclude_list, args.ads)
+    edge_cases = [case.format(word) for case in EDGE_CASES for word in exclude_list if len(word.split()) == 1]
+
+    matcher = ExcludeMatcher(exclude_list)
+    mismatches = [text for text in ads + edge_cases
+                  if (nltk_exclude(exclude_list, text) is None) != (matcher.search(text) is None)]
+    excluded = sum(matcher.search(text) is not None for text in ads)
+
+    t_nltk = min(timeit.repeat(lambda: [nltk_exclude(exclude_list, t) for t in ads], number=1, repeat=3))
+    t_matcher = min(timeit.repeat(lambda: [matcher.search(t) for t in ads], number=1, repeat=3))
+
+    print(f"{len(exclude_list)} exclude words, {len(ads)} ads, {excluded} excluded, "
+          f"{len(mismatches)} mismatches (with {len(edge_cases)} punctuation edge cases)")
+    print(f"nltk loop:      {t_nltk / len(ads) * 1e6:8.1f} us/ad")
+    print(f"ExcludeMatcher: {t_matcher / len(ads) * 1e6:8.1f} us/ad")
+    print(f"speedup:        {t_nltk / t_matcher:8.1f}x")
+    for text in mismatches[:5]:
+        print('mismatch:', text)
+
+
+if __name__ == '__main__':
+    main()
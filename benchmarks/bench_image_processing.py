@@ -0,0 +1,59 @@
+"""
+Bytes saved and CPU time per image of the image processing stage, for a few
+max edges, formats and qualities, on synthetic photos the size of the Kijiji
+full-size images (1600x1200 JPEG at quality 90).
+
+Runs process_image in this process, the CPU time is the one the worker
+processes of ImageProcessor add to a run.
+
+    python benchmarks/bench_image_processing.py [--images 10]
+"""
+import argparse
+import io
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from image_processing import THUMBNAIL_EDGE, process_image  # noqa: E402
+
+SETTINGS = [(1600, 'JPEG', 80), (1280, 'JPEG', 80), (1024, 'JPEG', 75), (1280, 'WEBP', 80), (1024, 'WEBP', 75)]
+
+
+def make_photo(rnd, width=1600, height=1200):
+    # Smooth shapes with sensor noise, compresses like a photo rather than like noise
+    small = rnd.randint(0, 256, (height // 40, width // 40, 3)).astype(np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.BICUBIC).filter(ImageFilter.GaussianBlur(3))
+    noisy = np.asarray(image).astype(np.int16) + rnd.randint(-6, 7, (height, width, 3))
+    out = io.BytesIO()
+    Image.fromarray(noisy.clip(0, 255).astype(np.uint8)).save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the downscaling and re-encoding of the ad images")
+    parser.add_argument('--images', type=int, default=10, help="Images processed per setting")
+    args = parser.parse_args()
+
+    rnd = np.random.RandomState(0)
+    photos = [make_photo(rnd) for _ in range(args.images)]
+    original = sum(len(photo) for photo in photos)
+    print(f"{args.images} images, {original / len(photos) / 1024:.0f} KB each")
+    for max_edge, image_format, quality in SETTINGS:
+        stored = thumbnails = cpu = 0
+        for photo in photos:
+            image, thumbnail, seconds = process_image(photo, max_edge, image_format, quality, THUMBNAIL_EDGE)
+            stored += min(len(image), len(photo))
+            thumbnails += len(thumbnail)
+            cpu += seconds
+        print(f"{image_format:4} {max_edge:4}px q{quality}: {stored / len(photos) / 1024:4.0f} KB per image "
+              f"({100 * (1 - stored / original):3.0f}% saved), thumbnail {thumbnails / len(photos) / 1024:3.0f} KB, "
+              f"{cpu / len(photos) * 1000:4.0f} ms CPU per image")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Memory kept per ad by the KijijiAd objects of a crawl, once the pages they
+were read from are dropped: the slotted KijijiAd that only keeps strings,
+against a KijijiAd that also holds on to its listing tree as it used to, which
+keeps the whole parse tree of its page alive.
+
+Parses the search page fixture --pages times and measures the memory still
+allocated after the soups are released, with tracemalloc.
+
+    python benchmarks/bench_kijiji_ad_memory.py [--pages 20]
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'kijiji_scraper'))
+
+from kijiji_ad import KijijiAd  # noqa: E402
+from make_fixtures import SEARCH_PAGE, read_fixture  # noqa: E402
+
+
+class TreeKijijiAd(KijijiAd):
+    # KijijiAd keeping its listing tree, as before it was slotted
+    def __init__(self, ad):
+        super().__init__(ad)
+        self.ad = ad
+
+
+def crawl(ad_class, content, n_pages):
+    ads = []
+    for _ in range(n_pages):
+        soup = BeautifulSoup(content, 'html.parser')
+        ads += [ad_class(listing) for listing in soup.find_all("div", {"class": "search-item regular-ad"})]
+    return ads
+
+
+def retained(ad_class, content, n_pages):
+    """
+    :return: number of ads and bytes still allocated for them after the crawl
+    """
+    gc.collect()
+    tracemalloc.start()
+    ads = crawl(ad_class, content, n_pages)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(ads), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=20, help="Number of times the fixture page is parsed")
+    args = parser.parse_args()
+
+    content = read_fixture(SEARCH_PAGE)
+    print(f'{args.pages} pages of {len(content) / 1024:.0f} KB')
+    results = {name: retained(ad_class, content, args.pages)
+               for name, ad_class in [('with tree', TreeKijijiAd), ('slotted', KijijiAd)]}
+    for name, (n_ads, size) in results.items():
+        print(f'{name:10} {n_ads} ads  {size / 1024:9.0f} KB  {size / n_ads / 1024:7.1f} KB per ad')
+    print(f'x{results["with tree"][1] / results["slotted"][1]:.0f} less memory')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Repost detection against a history of sent ads: time to index the history,
+size of the index file, and time per lookup of a new ad, for reposts of sent
+ads (a word added, a word dropped, punctuation and case changed) and for ads
+that are not reposts. Also counts the reposts found and the ads wrongly taken
+for reposts.
+
+The histories of the other benchmarks are written with 20 words, which would
+make every ad look like every other, here they use VOCABULARY_SIZE words.
+
+    python benchmarks/bench_repost_index.py [--ads 100000] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'kijiji_scraper'))
+
+from ad_store import AdStore  # noqa: E402
+from repost_index import RepostIndex  # noqa: E402
+from make_fixtures import WORDS, make_history  # noqa: E402
+
+VOCABULARY_SIZE = 5000
+
+
+def vocabulary(rnd, size=VOCABULARY_SIZE):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return WORDS + [''.join(rnd.choice(letters) for _ in range(rnd.randint(3, 9))) for _ in range(size)]
+
+
+def repost(rnd, info, words):
+    # The same item listed again with a slightly edited text
+    description = info['Description'].split()
+    del description[rnd.randrange(len(description))]
+    description.insert(rnd.randrange(len(description)), rnd.choice(words))
+    return dict(info, Title=info['Title'].upper() + '!', Description=', '.join(description))
+
+
+def time_lookups(index, ads):
+    found = 0
+    times = []
+    for ad_id, info in ads:
+        start = time.perf_counter()
+        original, _ = index.find(info, ad_id=ad_id)
+        times.append(time.perf_counter() - start)
+        found += original is not None
+    times.sort()
+    return found, sum(times) / len(times) * 1e6, times[int(len(times) * 0.99)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repost index against a history of sent ads")
+    parser.add_argument('--ads', type=int, default=100000, help="Sent ads in the history")
+    parser.add_argument('--lookups', type=int, default=2000, help="Reposts and new ads looked up")
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    words = vocabulary(rnd)
+    history = make_history(args.ads, sent=True, words=words)
+    ad_store = AdStore()
+    ad_store.import_ads(history, sent=True)
+    ad_store.commit()
+    with tempfile.TemporaryDirectory() as tmp:
+        index = RepostIndex(os.path.join(tmp, 'ads.reposts.db'))
+        start = time.perf_counter()
+        index.rebuild(ad_store)
+        build = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+        print(f"Indexed {args.ads} ads in {build:.1f}s ({build / args.ads * 1e6:.0f} us per ad), "
+              f"{size / 1024 / 1024:.1f} MB")
+
+        sent = rnd.sample(list(history.items()), args.lookups)
+        reposts = [(f'r{ad_id}', repost(rnd, info, words)) for ad_id, info in sent]
+        new_ads = [(f'n{ad_id}', info) for ad_id, info in make_history(args.lookups, seed=2, words=words).items()]
+        for name, ads in (('reposts', reposts), ('new ads', new_ads)):
+            found, mean, p99 = time_lookups(index, ads)
+            print(f"{name:8} {mean:7.0f} us per lookup, p99 {p99:5.0f} us, "
+                  f"{found}/{len(ads)} taken for reposts")
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Per-page cost of the search page parser backends: the lxml parser and the
+full html.parser tree that find_ads used before.
+
+Uses the checked-in fixture and synthetic search pages in the Kijiji markup.
+Checks the parity of every backend with the full tree: the same listings,
+info dicts, third-party ads, next page and title, and lists the fields where
+a backend differs. Exits with an error if a backend differs.
+
+    python benchmarks/bench_search_parsers.py [--ads 40] [--pages 20]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'kijiji_scraper'))
+
+from make_fixtures import SEARCH_PAGE, make_page  # noqa: E402
+from search_parsers import BACKENDS  # noqa: E402
+
+
+def compare(reference, page):
+    """
+    :return: Counter of what differs between two SearchPages, by info field
+        name, "ids", "third-party ids", "next url" and "title"
+    """
+    differences = Counter()
+    differences['next url'] += reference.next_url != page.next_url
+    differences['title'] += reference.title != page.title
+    differences['third-party ids'] += reference.third_party_ids != page.third_party_ids
+    if [ad_id for ad_id, _ in reference.ads] != [ad_id for ad_id, _ in page.ads]:
+        differences['ids'] += 1
+        return +differences
+    for (_, expected), (_, info) in zip(reference.ads, page.ads):
+        for field in expected.keys() | info.keys():
+            differences[field] += expected.get(field) != info.get(field)
+    return +differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--ads', type=int, default=40, help="Listings per page")
+    parser.add_argument('--pages', type=int, default=20, help="Number of synthetic pages")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    pages = [make_page(rnd, args.ads, 1600000000 + i * 100) for i in range(args.pages)]
+    print(f'{args.pages} pages of {args.ads} listings, {sum(map(len, pages)) / len(pages) / 1024:.0f} KB per page')
+
+    with open(SEARCH_PAGE, 'rb') as f:
+        checked = [f.read()] + pages
+    references = [BACKENDS['bs4'](content) for content in checked]
+    differences = {name: sum((compare(ref, backend(content)) for ref, content in zip(references, checked)),
+                             Counter())
+                   for name, backend in BACKENDS.items()}
+
+    times = {}
+    for name, backend in BACKENDS.items():
+        times[name] = min(timeit.repeat(lambda: [backend(content) for content in pages], number=1, repeat=3))
+    for name in BACKENDS:
+        per_page = times[name] / len(pages) * 1000
+        speedup = times['bs4'] / times[name]
+        fields = ', '.join(f'{field} ({count})' for field, count in sorted(differences[name].items()))
+        print(f'{name:10} {per_page:8.2f} ms per page  x{speedup:5.1f}  '
+              f'differences with bs4: {fields or "none"}')
+    # Every backend must give the same ads whichever reads a page
+    if any(differences.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Startup cost of the entry points: the time Python spends importing modules
+before a command does anything, as reported by `python -X importtime`.
+
+Each entry point is started --runs times with --help, which parses the
+arguments and exits, so only the imports done at module load are counted.
+The imports of a bare interpreter (site, encodings...) are measured the same
+way and subtracted. The median is compared with the budget of the entry point
+and the script exits with status 1 when one of them is over budget.
+
+    python benchmarks/bench_startup.py [--runs 7] [--budget notifier=150]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point -> (command line, import time budget in ms)
+ENTRY_POINTS = {
+    'scraper': (['src/kijiji_scraper/main.py', '--help'], 50),
+    'notifier': (['src/main.py', '--help'], 150),
+    'notifier-main': (['src/main.py', 'main', '--help'], 150),
+    'notifier-daemon': (['src/main.py', 'daemon', '--help'], 150),
+}
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: output of python -X importtime
+    :return: total import time in ms, dict of top level module -> cumulative time in ms
+    """
+    total, top_level = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        # Imported modules are indented under the module importing them
+        if not name[1:].startswith(' '):
+            top_level[name.strip()] = int(cumulative_us) / 1000
+    return total / 1000, top_level
+
+
+def measure(args, runs):
+    """
+    :return: median import time in ms, median wall time in ms, top level modules of the last run
+    """
+    import_times, wall_times = [], []
+    top_level = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=ROOT,
+                              capture_output=True, text=True)
+        wall_times.append((time.perf_counter() - start) * 1000)
+        if proc.returncode != 0:
+            raise RuntimeError(f'{" ".join(args)} exited with {proc.returncode}:\n{proc.stderr[-2000:]}')
+        import_time, top_level = parse_importtime(proc.stderr)
+        import_times.append(import_time)
+    return statistics.median(import_times), statistics.median(wall_times), top_level
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the entry points against their budget")
+    parser.add_argument('--runs', type=int, default=7, help="Runs per entry point, the median is reported")
+    parser.add_argument('--top', type=int, default=5, help="Slowest top level imports to show per entry point")
+    parser.add_argument('--budget', metavar='ENTRY=MS', nargs='+', default=[],
+                        help="Override the import time budget of an entry point")
+    args = parser.parse_args()
+
+    budgets = {name: budget for name, (_, budget) in ENTRY_POINTS.items()}
+    for override in args.budget:
+        name, ms = override.split('=')
+        budgets[name] = float(ms)
+
+    # Compile the bytecode first so the first run doesn't count it
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', 'src'], cwd=ROOT, check=True)
+    interpreter_ms, _, _ = measure(['-c', 'pass'], args.runs)
+    print(f'{"interpreter":16} imports {interpreter_ms:7.1f} ms, subtracted below')
+
+    over_budget = []
+    for name, (entry_args, _) in ENTRY_POINTS.items():
+        import_ms, wall_ms, top_level = measure(entry_args, args.runs)
+        import_ms -= interpreter_ms
+        status = 'ok' if import_ms <= budgets[name] else 'OVER BUDGET'
+        print(f'{name:16} imports {import_ms:7.1f} ms  wall {wall_ms:7.1f} ms  '
+              f'budget {budgets[name]:5.0f} ms  {status}')
+        slowest = sorted((item for item in top_level.items() if item[0] not in ('site', 'encodings')),
+                         key=lambda item: item[1], reverse=True)[:args.top]
+        for module, ms in slowest:
+            print(f'    {module:30} {ms:7.1f} ms')
+        if import_ms > budgets[name]:
+            over_budget.append(name)
+
+    if over_budget:
+        print(f'Over budget: {", ".join(over_budget)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Synthetic Kijiji pages and ad histories for the benchmarks.
+
+The search and detail pages reproduce the markup the parsers read (listing
+divs, "Next" link, detail page images and ad type lines) around enough page
+furniture, scripts and a JSON-LD ItemList, to have the size of real pages.
+The pages the suite runs against are checked in under benchmarks/fixtures/
+so every run reads the same bytes; regenerate them with
+
+    python benchmarks/make_fixtures.py
+"""
+import html
+import json
+import os
+import random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SEARCH_PAGE = os.path.join(FIXTURES_DIR, 'search_page.html')
+DETAIL_PAGE = os.path.join(FIXTURES_DIR, 'detail_page.html')
+BUSINESS_DETAIL_PAGE = os.path.join(FIXTURES_DIR, 'detail_page_business.html')
+
+WORDS = ['teak', 'danish', 'modern', 'chair', 'table', 'dresser', 'vintage', 'solid', 'wood', 'walnut',
+         'sideboard', 'credenza', 'lamp', 'mid', 'century', 'great', 'condition', 'pick', 'up', 'calgary']
+LOCATIONS = ['Calgary', 'Airdrie', 'Cochrane', 'Okotoks']
+LISTING = """
+<div data-listing-id="{id}" data-vip-url="{path}" class="{classes}">
+  <div class="clearfix">
+    <div class="left-col">
+      <div class="image">
+        <picture><img data-src="{image}" src="https://ca.classistatic.com/static/V/placeholder.png" alt="{title}"></picture>
+      </div>
+    </div>
+    <div class="info">
+      <div class="info-container">
+        <div class="price">
+          {price}
+        </div>
+        <div class="title">
+          <a href="{path}" class="title">
+            {title}
+          </a>
+        </div>
+        <div class="location">
+          <span class="">{location}</span>
+          <span class="date-posted">{date}</span>
+        </div>
+        <div class="description">
+          {description}
+          {details}
+        </div>
+      </div>
+    </div>
+  </div>
+</div>
+"""
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+  <title>Teak | Buy &amp; Sell | Calgary | Kijiji</title>
+  {scripts}
+  <script type="application/ld+json">{json_ld}</script>
+</head>
+<body>
+  <header><nav>{nav}</nav></header>
+  <main>
+    <div class="message">We found results for <strong>"teak"</strong></div>
+    <div class="container-results">
+      {top_features}
+      {listings}
+    </div>
+    <div class="pagination">
+      <a href="/b-buy-sell/calgary/teak/page-2/k0c10l1700199?rb=true&amp;radius=50.0" title="Next">Next</a>
+    </div>
+  </main>
+  <footer>{footer}</footer>
+</body>
+</html>
+"""
+
+
+def make_ad(rnd, ad_id):
+    title = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 8))).capitalize()
+    return {
+        'id': str(ad_id),
+        'title': title,
+        'path': f'/v-furniture/calgary/{title.lower().replace(" ", "-")}/{ad_id}',
+        'image': f'https://media.kijiji.ca/api/v1/ca-prod-fsbo-ads/images/{ad_id}?rule=kijijica-200-jpg',
+        'price': round(rnd.uniform(5, 3000), 2),
+        'location': rnd.choice(LOCATIONS),
+        'date': rnd.choice(['< 9 minutes ago', '< 2 hours ago', '17/10/2026']),
+        'description': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(15, 40))),
+        'details': 'Condition: Used' if rnd.random() < 0.3 else '',
+    }
+
+
+def render_listing(ad, classes):
+    return LISTING.format(
+        id=ad['id'], path=ad['path'], classes=classes, image=ad['image'], title=html.escape(ad['title']),
+        price=f"${ad['price']:,.2f}", location=ad['location'], date=html.escape(ad['date']),
+        description=html.escape(ad['description']),
+        details=f'<div class="details">{ad["details"]}</div>' if ad['details'] else '')
+
+
+def json_ld(ads):
+    return json.dumps({
+        '@context': 'https://schema.org',
+        '@type': 'ItemList',
+        'itemListElement': [{
+            '@type': 'ListItem',
+            'position': i + 1,
+            'item': {
+                '@type': 'Product',
+                'productID': ad['id'],
+                'name': ad['title'],
+                'url': 'https://www.kijiji.ca' + ad['path'],
+                'image': ad['image'],
+                'description': ad['description'],
+                'offers': {'@type': 'Offer', 'price': f"{ad['price']:.2f}", 'priceCurrency': 'CAD',
+                           'availableAtOrFrom': {'address': {'addressLocality': ad['location']}}},
+            }} for i, ad in enumerate(ads)]})
+
+
+def make_page(rnd, n_ads, first_id):
+    ads = [make_ad(rnd, first_id + i) for i in range(n_ads)]
+    top_features = [make_ad(rnd, first_id + n_ads + i) for i in range(3)]
+    return PAGE.format(
+        scripts='\n'.join(f'<script>window.dataLayer{i} = {json.dumps(WORDS)};</script>' for i in range(30)),
+        json_ld=json_ld(ads),
+        nav=''.join(f'<a href="/c{i}">Category {i}</a>' for i in range(200)),
+        top_features=''.join(render_listing(ad, 'search-item showcase top-feature') for ad in top_features),
+        listings=''.join(render_listing(ad, 'search-item regular-ad') for ad in ads),
+        footer=''.join(f'<p><a href="/f{i}">Footer link {i}</a></p>' for i in range(200)),
+    ).encode()
+
+
+DETAIL_PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+  <title>{title} | Furniture | Calgary | Kijiji</title>
+  {scripts}
+</head>
+<body>
+  <header><nav>{nav}</nav></header>
+  <main>
+    <h1>{title}</h1>
+    <div class="gallery">
+      {images}
+    </div>
+    <div class="price">${price:,.2f}</div>
+    <div class="line-2791300917">{ad_type}</div>
+    <div class="line-2791300918">Condition: Used</div>
+    <div class="description-3373212">{description}</div>
+    <ul class="similar">{similar}</ul>
+  </main>
+  <footer>{footer}</footer>
+</body>
+</html>
+"""
+
+
+def make_detail_page(rnd, ad_id, n_images=8, business=False):
+    ad = make_ad(rnd, ad_id)
+    images = ''.join(f'<picture><img src="https://media.kijiji.ca/api/v1/ca-prod-fsbo-ads/images/{ad_id}/{i}'
+                     f'?rule=kijijica-640-jpg" alt="{html.escape(ad["title"])}"></picture>' for i in range(n_images))
+    return DETAIL_PAGE_TEMPLATE.format(
+        title=html.escape(ad['title']),
+        scripts='\n'.join(f'<script>window.dataLayer{i} = {json.dumps(WORDS)};</script>' for i in range(30)),
+        nav=''.join(f'<a href="/c{i}">Category {i}</a>' for i in range(200)),
+        images=images,
+        price=ad['price'],
+        ad_type='Business' if business else 'Owner',
+        description=html.escape(ad['description'] * 3),
+        similar=''.join(f'<li><a href="/v/{ad_id + i}">Similar ad {i}</a></li>' for i in range(40)),
+        footer=''.join(f'<p><a href="/f{i}">Footer link {i}</a></p>' for i in range(200)),
+    ).encode()
+
+
+def make_history(n_ads, seed=0, sent=False, words=WORDS):
+    """
+    :param words: vocabulary of the titles and descriptions
+    :return: dict of ad id -> ad info like the ads store holds, n_ads entries
+    """
+    rnd = random.Random(seed)
+    ads = {}
+    for ad_id in range(1500000000, 1500000000 + n_ads):
+        title = ' '.join(rnd.choice(words) for _ in range(rnd.randint(3, 8))).capitalize()
+        info = {
+            'Title': title,
+            'Image': f'<img src ="https://media.kijiji.ca/images/{ad_id}"/>',
+            'Url': f'http://www.kijiji.ca/v-furniture/calgary/{ad_id}',
+            'Details': '',
+            'Description': ' '.join(rnd.choice(words) for _ in range(12)),
+            'Date': '< 9 minutes ago',
+            'Location': rnd.choice(LOCATIONS),
+            'Price': f'${rnd.uniform(5, 3000):,.2f}',
+            'DataSource': f'https://media.kijiji.ca/images/{ad_id}',
+        }
+        if sent:
+            info['time_sent'] = '2026-10-17 09:00:00'
+        ads[str(ad_id)] = info
+    return ads
+
+
+def read_fixture(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def main():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    rnd = random.Random(0)
+    for path, content in [(SEARCH_PAGE, make_page(rnd, 40, 1600000000)),
+                          (DETAIL_PAGE, make_detail_page(rnd, 1600000001)),
+                          (BUSINESS_DETAIL_PAGE, make_detail_page(rnd, 1600000002, business=True))]:
+        with open(path, 'wb') as f:
+            f.write(content)
+        print(f'Wrote {path} ({len(content) / 1024:.0f} KB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""
+Offline micro-benchmark suite of the hot paths of a scraper and notifier run,
+against the HTML fixtures in benchmarks/fixtures/ and synthetic ad histories,
+so that the numbers only depend on the code and can be compared across
+commits.
+
+Every benchmark is timed with timeit autorange and repeated, the results are
+printed and can be written as JSON. Against a baseline JSON file from an
+earlier run, the suite exits with 1 when a benchmark is slower than the
+baseline by more than the threshold.
+
+    python benchmarks/run_suite.py [--full] [--filter find_ads] [--output results.json]
+                                   [--compare baseline.json] [--threshold 0.2]
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+import yaml
+from loguru import logger as log
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), 'src', 'kijiji_scraper'))
+
+from make_fixtures import SEARCH_PAGE, DETAIL_PAGE, BUSINESS_DETAIL_PAGE, make_history, read_fixture  # noqa: E402
+
+# Sizes of the synthetic ad histories, --full adds 1M
+SIZES = [1000, 100000]
+FULL_SIZES = SIZES + [1000000]
+
+# name -> (function, params), the function takes a param and returns the statement to time
+BENCHMARKS = {}
+# Files the benchmarks read, removed at the end of the run
+TMP_DIR = tempfile.TemporaryDirectory(prefix='kijiji-benchmarks-')
+
+
+def benchmark(*params):
+    """
+    Register a benchmark. The decorated function sets up its data for one of
+    the params, outside of the timing, and returns the callable to time.
+    """
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, params)
+        return setup
+    return register
+
+
+def exclude_list():
+    # The longest exclude list of the example config
+    with open(os.path.join(os.path.dirname(ROOT), 'scraper_config.yaml')) as f:
+        urls = list(yaml.safe_load_all(f))[1]
+    return [str(word) for word in max((url.get('exclude', []) for url in urls), key=len)]
+
+
+@benchmark('lxml', 'bs4')
+def parse_search_page(backend):
+    from bench_search_parsers import compare
+    from search_parsers import BACKENDS
+    content = read_fixture(SEARCH_PAGE)
+    # A backend is only faster if it reads the same ads as the full tree
+    differences = compare(BACKENDS['bs4'](content), BACKENDS[backend](content))
+    if differences:
+        sys.exit(f'The {backend} parser differs from bs4 on {", ".join(sorted(differences))}')
+    return lambda: BACKENDS[backend](content)
+
+
+@benchmark(None)
+def kijiji_ad(_):
+    # KijijiAd on every listing of an already built tree
+    from bs4 import BeautifulSoup
+    from kijiji_ad import KijijiAd
+    soup = BeautifulSoup(read_fixture(SEARCH_PAGE), 'html.parser')
+    listings = soup.find_all("div", {"class": "search-item regular-ad"})
+    return lambda: [KijijiAd(ad).info for ad in listings]
+
+
+@benchmark(*SIZES)
+def find_ads(size):
+    # A page of ads that are all known already, the common case of a cron run,
+    # against a history of size ads
+    from ad_store import AdStore
+    from kijiji_scraper import KijijiScraper
+    from search_parsers import parse_search_page
+    page = parse_search_page(read_fixture(SEARCH_PAGE))
+    ad_store = AdStore()
+    ad_store.import_ads(make_history(size))
+    ad_store.import_ads(dict(page.ads))
+    ad_store.commit()
+    scraper = KijijiScraper(filename=None, ad_store=ad_store)
+    scraper.set_exclude_list(exclude_list())
+    return lambda: scraper.find_ads(page)
+
+
+@benchmark(*SIZES)
+def exclude_matcher(size):
+    # The exclude check of find_ads over size ad texts
+    from exclude_matcher import ExcludeMatcher
+    matcher = ExcludeMatcher([word.lower() for word in exclude_list()])
+    texts = [info["Title"].lower() + " " + info["Description"].lower() for info in make_history(size).values()]
+    return lambda: [matcher.search(text) for text in texts]
+
+
+@benchmark('owner', 'business')
+def ad_detail(ad_type):
+    # is_posted_by_business and parse_ad_images of an ad whose detail page was
+    # not parsed yet, as for every new ad
+    scraper = offline_ad_scraper({'owner': read_fixture(DETAIL_PAGE), 'business': read_fixture(BUSINESS_DETAIL_PAGE)})
+    ad = {'Url': ad_type}
+
+    def run():
+        scraper.ad_details.clear()
+        return scraper.is_posted_by_business(ad), scraper.parse_ad_images(ad)
+    return run
+
+
+@benchmark(*SIZES)
+def open_json_corrupt(size):
+    # Recovery of a sent ads file cut off in the middle of an ad
+    open_json = notifier_main().open_json
+    txt = json.dumps(make_history(size, sent=True), indent=2)
+    path = os.path.join(TMP_DIR.name, f'sent_ads_corrupt_{size}.json')
+    with open(path, 'w') as f:
+        f.write(txt[:len(txt) - 200])
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return open_json(path)
+    return run
+
+
+@benchmark(*SIZES)
+def get_ads_summary(size):
+    from launcher import get_ads_summary
+    ads = make_history(size)
+    return lambda: get_ads_summary(ads)
+
+
+@benchmark(*SIZES)
+def email_body(size):
+    # HTML body of a digest of size ads
+    from email_client import EmailClient
+    client = EmailClient({})
+    ads = make_history(size)
+    return lambda: client._EmailClient__create_email_body([('Teak', ads)])
+
+
+def notifier_main():
+    # src/main.py, which kijiji_scraper/main.py shadows on the path
+    spec = importlib.util.spec_from_file_location('notifier_main', os.path.join(os.path.dirname(ROOT), 'src', 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def offline_ad_scraper(pages):
+    # adscraper imports the Dropbox and Telegram clients, only when needed
+    from adscraper import AdScraper, AdDetail
+
+    class OfflineAdScraper(AdScraper):
+        """
+        AdScraper reading the detail pages from fixtures, keyed by ad Url,
+        without the Dropbox and Telegram clients.
+        """
+
+        def __init__(self, pages):
+            self.pages = pages
+            self.ad_details = {}
+
+        def get_ad_detail(self, ad):
+            key = ad.get('Id', ad['Url'])
+            if key not in self.ad_details:
+                self.ad_details[key] = AdDetail(ad['Url'], self.pages[ad['Url']])
+            return self.ad_details[key]
+
+    return OfflineAdScraper(pages)
+
+
+def run_benchmark(name, param, repeat):
+    stmt = BENCHMARKS[name][0](param)
+    timer = timeit.Timer(stmt)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'name': name if param is None else f'{name}[{param}]',
+        'benchmark': name,
+        'param': param,
+        'number': number,
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    :param threshold: slow down of the median over the baseline that counts as
+        a regression, 0.2 is 20% slower
+    :return: names of the regressed benchmarks
+    """
+    baseline = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        ratio = result['median'] / before['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(result['name'])
+            flag = '  REGRESSION'
+        print(f'{result["name"]:32} {before["median"] * 1000:10.3f} -> {result["median"] * 1000:10.3f} ms'
+              f'  x{ratio:5.2f}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--full', action='store_true', help="Also run the 1M ads history sizes")
+    parser.add_argument('--filter', help="Regular expression of the benchmark names to run")
+    parser.add_argument('--repeat', type=int, default=5, help="Timings per benchmark")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Baseline results JSON file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slow down over the baseline that fails the run, default 0.2 (20%%)")
+    args = parser.parse_args()
+
+    # The scraper logs every ad it skips or finds
+    log.remove()
+    log.add(sys.stderr, level='WARNING')
+
+    results = []
+    with TMP_DIR:
+        for name, (_, params) in BENCHMARKS.items():
+            if params == tuple(SIZES) and args.full:
+                params = FULL_SIZES
+            for param in params:
+                full_name = name if param is None else f'{name}[{param}]'
+                if args.filter and not re.search(args.filter, full_name):
+                    continue
+                result = run_benchmark(name, param, args.repeat)
+                results.append(result)
+                print(f'{full_name:32} {result["median"] * 1000:10.3f} ms  '
+                      f'(min {result["min"] * 1000:.3f}, stdev {result["stdev"] * 1000:.3f})')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+        print(f'Wrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'\nCompared with {args.compare}')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks slower than the baseline by more than '
+                  f'{args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
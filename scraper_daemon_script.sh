@@ -0,0 +1,2 @@
+export PATH=/usr/local/bin
+python /opt/app/src/main.py daemon --scraper-config /opt/app/scraper_config.yaml --ads-db-loc /opt/app/ads.db --sent-ads-json-loc /opt/app/sent_ads.json --sync-dropbox-locations --ignore-business-ads --retention-days 90
@@ -1,4 +1,3 @@
 #!/usr/bin/zsh
 export PATH=/usr/local/bin
-python src/kijiji_scraper/main.py --conf scraper_config.yaml --skipmail --ads config_ads.json
-python src/main.py --all-ads-json-loc config_ads.json --sent-ads-json-loc sent_ads.json --sync-dropbox-locations --ignore-business-ads
+python src/main.py pipeline --scraper-config scraper_config.yaml --ads-db-loc ads.db --sent-ads-json-loc sent_ads.json --sync-dropbox-locations --ignore-business-ads --adaptive
@@ -1,18 +1,28 @@
 import os
+from collections import Counter
+from concurrent.futures import as_completed
 from datetime import datetime
-from typing import Dict
 
 import dropbox
 import dropboxdrivefs as dbx
-import requests_cache
 import telegram
-from bs4 import BeautifulSoup
 from loguru import logger as log
 import requests
 from telegram.error import RetryAfter
+from telegram.utils.request import Request
 
-cached_requests = requests_cache.CachedSession('http_cache', backend='sqlite',
-                                               use_temp=True)
+import metrics
+import profiling
+from artefact_store import ArtefactStore
+from image_pipeline import ImagePipeline
+from repost_index import RepostIndex
+from telegram_dispatch import ChatFanout, TelegramDispatcher
+
+# Largest media group Telegram accepts, i.e. the most ads in one digest album
+DIGEST_SIZE = 10
+# What to send for a repost of an ad already sent: the ad as for a new one, a
+# one line "relisted" note, or nothing
+REPOST_ACTIONS = ('send', 'note', 'suppress')
 
 
 class DropboxDriveFS(dbx.DropboxDriveFileSystem):
@@ -33,26 +43,48 @@ class DropboxDriveFS(dbx.DropboxDriveFileSystem):
         self.session.auth = ("Authorization", self.token)
 
 
+class AdDetail:
+    """
+    Fields extracted from an ad detail page. The page is fetched and parsed once,
+    and the parse tree is dropped as soon as the fields are extracted.
+    """
+
+    def __init__(self, url, content):
+        from bs4 import BeautifulSoup
+        self.url = url
+        soup = BeautifulSoup(content, "html.parser")
+        self.images = [im.get('src') for im in soup.find_all('img')]
+        ad_type = soup.find_all('div', {'class': lambda x: x
+                                                           and 'line' in x.split('-')
+                                        })
+        self.ad_types = set([x.text.lower() for x in ad_type])
+        self.is_business = 'business' in self.ad_types
+        soup.decompose()
+
+    @classmethod
+    def fetch(cls, url):
+        log.debug(f"Getting ad detail page: {url}")
+        from http_cache import shared_cache
+        with profiling.stage('detail fetch'):
+            page = shared_cache().get(url, 'detail')
+        with profiling.stage('detail parse'):
+            return cls(url, page.content)
+
+
 class AdScraper:
-    def __init__(self, all_ads: Dict, sent_ads: Dict = None,
-                 dropbox_token=None,
-                 telegram_token=None, telegram_chat_id=None, ignore_business_ads=True):
+    def __init__(self, ad_store, dropbox_token=None,
+                 telegram_token=None, telegram_chat_id=None, ignore_business_ads=True, digest_threshold=10,
+                 reposts='note', image_processor=None, chat_routes=None):
+        if reposts not in REPOST_ACTIONS:
+            raise ValueError(f'reposts must be one of {REPOST_ACTIONS}, not {reposts}')
         self.ignore_business_ads = ignore_business_ads
+        self.reposts = reposts
+        self.digest_threshold = digest_threshold
         self.telegram_token = telegram_token
         self.telegram_chat_id = telegram_chat_id
-        self.all_ads = all_ads.copy()
-        self.ads = all_ads.copy()
-        # Load sent and all adds, and then calculate the difference
-        if sent_ads is None:
-            self.sent_ads = {}
-        else:
-            self.sent_ads = sent_ads
-
-        for k in self.sent_ads.keys():
-            if k in self.ads.keys():
-                del self.ads[k]
-        log.debug(f'Found {len(self.ads)} new ads')
-        self.ids = list(self.ads.keys())
+        # Ads found by the scraper that were not sent yet
+        self.ad_store = ad_store
+        self.refresh_ads()
 
         if dropbox_token is None:
             dropbox_token = os.environ['DROPBOX_ACCESS_TOKEN']
@@ -69,12 +101,43 @@ class AdScraper:
                                          app_secret=os.environ['APP_SECRET'])
         self.telegram_token = telegram_token
         self.telegram_chat_id = telegram_chat_id
-        self.bot = telegram.Bot(self.telegram_token)
+        # Search url -> ids of the chats its ads go to, the ads of the other
+        # searches go to telegram_chat_id
+        self.chat_routes = chat_routes or {}
+        chats = {self.telegram_chat_id, *(chat for route in self.chat_routes.values() for chat in route)}
+        # A connection for every chat sending at the same time
+        self.bot = telegram.Bot(self.telegram_token, request=Request(con_pool_size=len(chats) + 1))
+        self.fanout = ChatFanout(self.bot)
+        self.image_pipeline = ImagePipeline()
+        # Index of the images already stored, next to the ad store. An ImageProcessor
+        # downscales the images before they are stored
+        self.artefacts = ArtefactStore(ad_store.filepath.with_suffix('.artefacts.db') if ad_store.filepath else None,
+                                       processor=image_processor)
+        # Near-duplicate index of the sent ads, also next to the ad store
+        self.repost_index = RepostIndex(ad_store.filepath.with_suffix('.reposts.db') if ad_store.filepath else None)
+        if reposts != 'send' and len(self.repost_index) == 0 and ad_store.sent_count():
+            self.repost_index.rebuild(ad_store)
+
+    def refresh_ads(self):
+        """
+        Reload the ads that were not sent yet from the ad store, e.g. after a
+        scrape in a long-running process.
+        """
+        self.ads = self.ad_store.unsent()
+        log.debug(f'Found {len(self.ads)} new ads')
+        self.ids = list(self.ads.keys())
+        # Parsed detail pages, keyed by ad id
+        self.ad_details = {}
 
-    def send_telegram_ad(self, ad):
+    def telegram_media(self, ad):
+        """
+        Build the media group of an ad, and record whether it was posted by a business.
+
+        :return: list of InputMediaPhoto with the caption on the first one, empty if
+            the ad has no images, None if the ad is skipped as a business ad
+        """
         imgs = self.parse_ad_images(ad)
         imgs = imgs[:4]
-        current_ts_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         if imgs is not None and len(imgs) > 0:
             media = [telegram.InputMediaPhoto(img) for img in imgs]
@@ -87,61 +150,204 @@ class AdScraper:
 
         if self.ignore_business_ads and is_business:
             log.info(f"Skipping (ignore business = {self.ignore_business_ads}) business ad: {ad['Url']}")
-            ad['time_sent'] = current_ts_str
-            return True
+            ad['time_sent'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            return None
+        return media
+
+    def chats_of(self, ad):
+        """
+        :return: the chats an ad goes to that don't have it yet, the chats of its
+            search in chat_routes or telegram_chat_id
+        """
+        chats = self.chat_routes.get(ad.get('original_url')) or [self.telegram_chat_id]
+        delivered = self.ad_store.delivered_chats(ad['Id'])
+        return [chat for chat in chats if chat not in delivered]
 
+    def deliver(self, dispatcher, kind, send, payload):
+        """
+        Send a message with send(dispatcher, payload), on the thread of the chat
+        of dispatcher.
+
+        :return: 'sent', 'failed' when it raised, it is not sent again, or
+            'retry' when Telegram still answered RetryAfter after the retries,
+            to send it again on the next run
+        """
         try:
-            if len(media) > 0:
-                resp = self.bot.send_media_group(chat_id=self.telegram_chat_id, media=media)
-                if resp:
-                    ad['time_sent'] = current_ts_str
-                    self.sent_ads[ad['Id']] = ad
-            else:
-                ad['time_sent'] = current_ts_str
+            with metrics.TELEGRAM_SEND_SECONDS.labels(kind).time(), profiling.stage('send'):
+                resp = send(dispatcher, payload)
         except RetryAfter:
-            log.error(f"Telegram exceeded rate limit, will skip the ad")
-            return False
+            log.error(f"Telegram still exceeded rate limit after retries, will send again to chat "
+                      f"{dispatcher.chat_id} later")
+            return 'retry'
         except Exception as e:
             log.exception(e)
-        return True
+            return 'failed'
+        return 'sent' if resp else 'failed'
+
+    def repost_of(self, ad):
+        """
+        :return: id of the sent ad this ad is a repost of, None if it is not a repost
+        """
+        if self.reposts == 'send':
+            return None
+        with profiling.stage('filter'):
+            original, similarity = self.repost_index.find(ad, ad_id=ad['Id'])
+        if original is not None:
+            log.info(f"Ad {ad['Id']} is a repost of ad {original} ({similarity:.0%} similar)")
+        return original
+
+    def repost_note(self, ad, original):
+        """
+        The "relisted" note of a repost, sent instead of the ad so that its detail
+        page is not fetched and its images are not uploaded.
+
+        :return: text of the note, None with reposts='suppress'
+        """
+        metrics.REPOSTS.labels(self.reposts).inc()
+        ad['repost_of'] = original
+        if self.reposts == 'suppress':
+            return None
+        original_url = self.ad_store.get(original, {}).get('Url')
+        text = f"Relisted: {ad['Title']} - {ad['Price']} - {ad['Url']}"
+        if original_url:
+            text += f"\nSent before as {original_url}"
+        return text
+
+    def send_telegram_ads(self, ads):
+        """
+        Send ads to their chats, see chats_of. A chat gets each ad as one media
+        group or, when more than digest_threshold ads are waiting for it, as
+        digest albums of up to DIGEST_SIZE ads with one photo per ad. Reposts
+        of sent ads only get a note, see repost_note.
+
+        The detail pages are fetched here, one ad after the other, while every
+        chat sends its messages in order on its own thread. The delivery of an
+        ad to a chat is recorded as soon as the chat is done with it, and the
+        ad is yielded once all its chats are.
+
+        :return: iterator of (ad, is_sent), is_sent is False when a chat is to
+            get the ad again on the next run
+        """
+        ads = list(ads)
+        chats = {ad['Id']: self.chats_of(ad) for ad in ads}
+        waiting = Counter(chat for ad_chats in chats.values() for chat in ad_chats)
+        for chat, n_ads in waiting.items():
+            dispatcher = self.fanout.dispatcher(chat)
+            if n_ads <= self.digest_threshold:
+                log.info(f'Sending {n_ads} ads to chat {chat}, about {dispatcher.drain_time(4 * n_ads):.0f}s')
+            else:
+                log.info(f'{n_ads} ads waiting for chat {chat}, sending digests of {DIGEST_SIZE} ads per album, '
+                         f'about {dispatcher.drain_time(n_ads):.0f}s')
+
+        # future -> (chat, ads of the message)
+        jobs = {}
+        # Digest albums being filled, chat -> list of (ad, captioned photo)
+        batches = {}
+        # ad id -> [ad, chats not done yet, is_sent]
+        pending = {}
+        for ad in ads:
+            ad_chats = chats[ad['Id']]
+            if not ad_chats:
+                # Delivered to every chat by a previous run
+                yield ad, True
+                continue
+            original = self.repost_of(ad)
+            if original is not None:
+                text = self.repost_note(ad, original)
+                if text is None:
+                    ad['time_sent'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    yield ad, True
+                    continue
+                for chat in ad_chats:
+                    jobs[self.fanout.submit(chat, self.deliver, 'note', TelegramDispatcher.send_message, text)] = \
+                        (chat, [ad])
+            else:
+                media = self.telegram_media(ad)
+                if not media:
+                    # Business ad skipped or ad without images, nothing to send
+                    ad['time_sent'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    yield ad, True
+                    continue
+                for chat in ad_chats:
+                    if waiting[chat] <= self.digest_threshold:
+                        jobs[self.fanout.submit(chat, self.deliver, 'ad', TelegramDispatcher.send_media_group,
+                                                media)] = (chat, [ad])
+                        continue
+                    batch = batches.setdefault(chat, [])
+                    batch.append((ad, media[0]))
+                    if len(batch) == DIGEST_SIZE:
+                        jobs[self.__submit_digest(chat, batch)] = (chat, [ad for ad, _ in batch])
+                        batches[chat] = []
+            pending[ad['Id']] = [ad, len(ad_chats), True]
+        for chat, batch in batches.items():
+            if batch:
+                jobs[self.__submit_digest(chat, batch)] = (chat, [ad for ad, _ in batch])
+
+        for future in as_completed(jobs):
+            chat, job_ads = jobs[future]
+            outcome = future.result()
+            current_ts_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for ad in job_ads:
+                state = pending[ad['Id']]
+                if outcome == 'retry':
+                    state[2] = False
+                else:
+                    if outcome == 'sent':
+                        ad['time_sent'] = current_ts_str
+                    with profiling.stage('persist'):
+                        self.ad_store.mark_delivered(ad['Id'], chat, current_ts_str)
+                state[1] -= 1
+                if state[1] == 0:
+                    yield ad, state[2]
+
+    def __submit_digest(self, chat, batch):
+        # Queues a list of (ad, captioned photo) as one album
+        return self.fanout.submit(chat, self.deliver, 'digest', TelegramDispatcher.send_media_group,
+                                  [photo for _, photo in batch])
+
+    def close(self):
+        """
+        Wait for the messages and image transfers still queued and release the
+        chat threads, image pipeline and artefact store.
+        """
+        self.fanout.close()
+        self.image_pipeline.close()
+        self.artefacts.close()
+
+    def get_ad_detail(self, ad) -> AdDetail:
+        """
+        Return the parsed detail page of an ad, fetching it on first use only.
+
+        :param ad: ad dict with at least the Url field
+        :return: AdDetail of the ad
+        """
+        key = ad.get('Id', ad['Url'])
+        if key not in self.ad_details:
+            self.ad_details[key] = AdDetail.fetch(ad['Url'])
+        return self.ad_details[key]
 
     def parse_ad_images(self, ad):
-        url = ad['Url']
-        log.debug(f"Getting images URLs from ad: {url}")
-        page = cached_requests.get(url)
-        soup = BeautifulSoup(page.content, "html.parser")
-        images = soup.find_all('img')
-        images_url = [im.get('src') for im in images]
+        images_url = self.get_ad_detail(ad).images
         log.debug(f"Found {len(images_url)} images")
         return images_url
 
     def is_posted_by_business(self, ad):
-        url = ad['Url']
-        log.debug(f"Getting images URLs from ad: {url}")
-        page = cached_requests.get(url)
-        soup = BeautifulSoup(page.content, "html.parser")
-        ad_type = soup.find_all('div', {'class': lambda x: x
-                                                           and 'line' in x.split('-')
-                                        })
-        ad_types = set([x.text.lower() for x in ad_type])
-        if 'business' in ad_types:
-            return True
-        else:
-            return False
+        return self.get_ad_detail(ad).is_business
+
+    def save_ad_artefacts(self, ad, ad_id, destination_folder, fs, n_images=5):
+        """
+        Queue the storage of the first images of an ad in the ArtefactStore under
+        destination_folder on fs. The images are transferred in the background by
+        the image pipeline, call image_pipeline.wait() to wait for them, then
+        artefacts.write_manifests() to write the manifests of the ads.
 
-    def save_ad_artefacts(self, ad, ad_id, destination_folder, fs,n_images = 5):
+        :return: list of futures of the queued transfers
+        """
         imgs = self.parse_ad_images(ad)[:n_images]
+        futures = []
         for i, img in enumerate(imgs):
 
             if img is not None:
-                try:
-                    final_dest = os.path.join(f'{destination_folder}/{ad_id}/', img.split('/')[-1] + '.jpg')
-                    log.debug(f"Saving image {i + 1}/{len(imgs)} to {final_dest}")
-                    img_resp = cached_requests.get(img)
-                    with fs.open(final_dest, mode='wb') as f:
-                        f.write(img_resp.content)
-                    log.debug(f"Uploaded {img} to {final_dest}")
-                except Exception as e:
-                    log.error('Failed to deliver image!')
-                    log.exception(e)
-        return 0
+                log.debug(f"Saving image {i + 1}/{len(imgs)} of ad {ad_id}")
+                futures.append(self.image_pipeline.run(self.artefacts.save, img, ad_id, i, destination_folder, fs))
+        return futures
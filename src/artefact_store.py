@@ -0,0 +1,296 @@
+import hashlib
+import io
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from loguru import logger as log
+
+import metrics
+import profiling
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uploaded_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    path TEXT PRIMARY KEY,
+    blob TEXT NOT NULL
+);
+"""
+# Blob stored for a path: the blob of the same path, or the one an alias points to
+BLOB_QUERY = 'SELECT path, size FROM blobs WHERE path = COALESCE((SELECT blob FROM aliases WHERE path = ?), ?)'
+
+
+class ArtefactStore:
+    """
+    Ad images stored by content: every distinct image is uploaded once to
+    <destination>/blobs/<2 first hex digits>/<sha256>.jpg and each ad gets a
+    <destination>/<ad id>/manifest.json listing the blobs of its images.
+
+    A local SQLite index records the sha256 of every image URL already
+    downloaded and the blobs already uploaded, so an image shown in several
+    searches is never downloaded again, and a repost of the same photo under
+    a new ad id or URL is downloaded but not uploaded again. Safe to share
+    between the threads of the image pipeline.
+
+    With an ImageProcessor, the images are downscaled and re-encoded before
+    they are uploaded, to <sha256><variant>.<extension> where the variant
+    names the size and quality, and a thumbnail of each goes to
+    <destination>/thumbnails/. The sha256 stays the one of the original bytes.
+    An image kept as it is, when re-encoding doesn't make it smaller or fails,
+    is uploaded to the plain <sha256>.jpg blob, which the processed path is
+    recorded as an alias of.
+    """
+
+    def __init__(self, filename=None, chunk_size=256 * 1024, timeout=30, processor=None):
+        self.filepath = Path(filename) if filename else None
+        self.db = sqlite3.connect(str(self.filepath) if self.filepath else ':memory:', check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.processor = processor
+        # Path of the blobs being uploaded -> Event set once the upload is done
+        self.uploading = {}
+        # ad id -> {image index: manifest entry}, written by write_manifests()
+        self.manifests = {}
+        # Counts since the last take_stats()
+        self.stats = self.__new_stats()
+
+    def save(self, url, ad_id, index, destination_folder, fs):
+        """
+        Store the image at url for an ad, downloading and uploading it only if
+        its bytes are not stored yet.
+
+        :param index: position of the image in the ad
+        :return: number of bytes uploaded, None if it failed
+        """
+        with profiling.stage('upload'):
+            try:
+                return self.__save(url, ad_id, index, destination_folder, fs)
+            except Exception as e:
+                metrics.UPLOAD_FAILURES.inc()
+                log.error('Failed to deliver image!')
+                log.exception(e)
+                return None
+
+    def __save(self, url, ad_id, index, destination_folder, fs):
+        start = time.perf_counter()
+        known = self.__query('SELECT sha256, size FROM images WHERE url = ?', (url,))
+        if known is not None:
+            sha256, size = known
+            path = self.blob_path(destination_folder, sha256)
+            blob = self.__query(BLOB_QUERY, (path, path))
+            if blob is not None:
+                self.__count(images=1, download_saved=size, upload_saved=blob[1])
+                self.__add_to_manifest(ad_id, index, url, sha256, *blob, destination_folder)
+                log.debug(f"{url} is already stored as {blob[0]}")
+                return 0
+
+        with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as body:
+            sha256, size = self.__download(url, body)
+            self.__count(images=1, downloaded=size)
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO images (url, sha256, size) VALUES (?, ?, ?)',
+                                (url, sha256, size))
+                self.db.commit()
+            path = self.blob_path(destination_folder, sha256)
+            with self.lock:
+                blob = self.db.execute(BLOB_QUERY, (path, path)).fetchone()
+                uploading = self.uploading.get(path)
+                if blob is None and uploading is None:
+                    self.uploading[path] = threading.Event()
+            if uploading is not None:
+                # Being uploaded by another thread, its manifest entry is known once it is done
+                uploading.wait()
+                blob = self.__query(BLOB_QUERY, (path, path))
+                if blob is None:
+                    raise RuntimeError(f'The upload of {path} by another thread failed')
+            if blob is not None:
+                self.__count(upload_saved=blob[1])
+                self.__add_to_manifest(ad_id, index, url, sha256, *blob, destination_folder)
+                log.debug(f"{url} has the same bytes as {blob[0]}, not uploading it again")
+                return 0
+            try:
+                body.seek(0)
+                if self.processor is None:
+                    stored_size = uploaded = self.__upload(body, path, sha256, fs)
+                    stored_path = path
+                else:
+                    stored_path, stored_size, uploaded = self.__process_and_upload(body.read(), path, sha256,
+                                                                                   destination_folder, fs)
+            finally:
+                with self.lock:
+                    self.uploading.pop(path).set()
+
+        self.__count(uploaded=uploaded)
+        metrics.UPLOAD_SECONDS.observe(time.perf_counter() - start)
+        metrics.UPLOAD_BYTES.inc(uploaded)
+        self.__add_to_manifest(ad_id, index, url, sha256, stored_path, stored_size, destination_folder)
+        log.debug(f"Uploaded {url} to {stored_path}")
+        return uploaded
+
+    def __upload(self, body, path, sha256, fs):
+        # Streams a file object to path and records the blob, returns its size
+        size = 0
+        with fs.open(path, mode='wb') as f:
+            while True:
+                chunk = body.read(self.chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                size += len(chunk)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO blobs (path, sha256, size, uploaded_at) '
+                            'VALUES (?, ?, ?, ?)', (path, sha256, size, time.time()))
+            self.db.commit()
+        return size
+
+    def __process_and_upload(self, data, path, sha256, destination_folder, fs):
+        # Uploads the processed image to path, or the original to the plain
+        # blob path, then its thumbnail. Returns the path and size of the image
+        # and the bytes uploaded
+        try:
+            image, thumbnail, cpu_seconds = self.processor.process(data)
+        except Exception as e:
+            log.warning(f'Could not process image {sha256}, storing it as it is: {e}')
+            image, thumbnail, cpu_seconds = None, None, 0
+        saved = len(data) - len(image) if image is not None else 0
+        self.__count(processing_saved=saved, processing_seconds=cpu_seconds)
+        metrics.ARTEFACT_PROCESSING_BYTES_SAVED.inc(saved)
+        metrics.ARTEFACT_PROCESSING_SECONDS.inc(cpu_seconds)
+        uploaded = 0
+        if thumbnail is not None:
+            uploaded += self.__upload(io.BytesIO(thumbnail), self.thumbnail_path(destination_folder, sha256),
+                                      sha256, fs)
+        if image is not None:
+            size = self.__upload(io.BytesIO(image), path, sha256, fs)
+            return path, size, uploaded + size
+
+        original = self.blob_path(destination_folder, sha256, processed=False)
+        blob = self.__query('SELECT size FROM blobs WHERE path = ?', (original,))
+        if blob is None:
+            size = self.__upload(io.BytesIO(data), original, sha256, fs)
+            uploaded += size
+        else:
+            # Uploaded by a run without processing
+            size = blob[0]
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO aliases (path, blob) VALUES (?, ?)', (path, original))
+            self.db.commit()
+        return original, size, uploaded
+
+    def blob_path(self, destination_folder, sha256, processed=True):
+        """
+        :param processed: path of the processed image, if there is an ImageProcessor
+        """
+        if self.processor is None or not processed:
+            return f'{destination_folder}/blobs/{sha256[:2]}/{sha256}.jpg'
+        return f'{destination_folder}/blobs/{sha256[:2]}/{sha256}{self.processor.variant}.{self.processor.extension}'
+
+    def thumbnail_path(self, destination_folder, sha256):
+        return (f'{destination_folder}/thumbnails/{sha256[:2]}/{sha256}-{self.processor.thumbnail_edge}.'
+                f'{self.processor.extension}')
+
+    def write_manifests(self, destination_folder, fs):
+        """
+        Write the manifest of every ad whose images were saved since the last call,
+        once the image pipeline is done with them.
+
+        :return: number of manifests written
+        """
+        with self.lock:
+            manifests, self.manifests = self.manifests, {}
+        for ad_id, images in manifests.items():
+            manifest = {'ad_id': ad_id, 'images': [images[index] for index in sorted(images)]}
+            try:
+                with fs.open(f'{destination_folder}/{ad_id}/manifest.json', mode='wb') as f:
+                    f.write(json.dumps(manifest, indent=2).encode())
+            except Exception as e:
+                log.error(f'Failed to write the manifest of ad {ad_id}')
+                log.exception(e)
+        return len(manifests)
+
+    def take_stats(self):
+        """
+        :return: the counts since the last call, e.g. of a run, and start new ones
+        """
+        with self.lock:
+            stats, self.stats = self.stats, self.__new_stats()
+        return stats
+
+    @staticmethod
+    def saved_bytes(stats):
+        return stats['download_saved'] + stats['upload_saved'] + stats['processing_saved']
+
+    def summary(self, stats):
+        """
+        :param stats: counts returned by take_stats()
+        :return: one line of the bytes transferred and saved by the dedup and
+            by the image processing
+        """
+        mb = 1024 * 1024
+        summary = (f"{stats['images']} images, {stats['downloaded'] / mb:.1f} MB downloaded, "
+                   f"{stats['uploaded'] / mb:.1f} MB uploaded, saved {stats['download_saved'] / mb:.1f} MB "
+                   f"of downloads and {stats['upload_saved'] / mb:.1f} MB of uploads")
+        if self.processor is not None:
+            summary += (f", processing saved {stats['processing_saved'] / mb:.1f} MB of uploads for "
+                        f"{stats['processing_seconds']:.1f}s of CPU")
+        return summary
+
+    @staticmethod
+    def __new_stats():
+        return dict.fromkeys(('images', 'downloaded', 'uploaded', 'download_saved', 'upload_saved',
+                              'processing_saved', 'processing_seconds'), 0)
+
+    def close(self):
+        if self.processor is not None:
+            self.processor.close()
+        self.session.close()
+        with self.lock:
+            self.db.close()
+
+    def __download(self, url, body):
+        digest = hashlib.sha256()
+        size = 0
+        with self.session.get(url, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                digest.update(chunk)
+                body.write(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def __query(self, query, params):
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
+
+    def __count(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+        metrics.ARTEFACT_BYTES_SAVED.inc(counts.get('download_saved', 0) + counts.get('upload_saved', 0))
+
+    def __add_to_manifest(self, ad_id, index, url, sha256, path, size, destination_folder):
+        entry = {'url': url, 'sha256': sha256, 'path': path, 'size': size}
+        if self.processor is not None:
+            thumbnail = self.thumbnail_path(destination_folder, sha256)
+            # No thumbnail for an image that could not be processed
+            if self.__query('SELECT 1 FROM blobs WHERE path = ?', (thumbnail,)) is not None:
+                entry['thumbnail'] = thumbnail
+        with self.lock:
+            self.manifests.setdefault(ad_id, {})[index] = entry
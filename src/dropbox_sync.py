@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import json
+import re
+import time
+
+from loguru import logger as log
+
+import metrics
+import profiling
+
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+SEGMENT_RE = re.compile(r'segment-(\d+)\.jsonl\.gz$')
+SNAPSHOT_RE = re.compile(r'snapshot-(\d+)\.jsonl\.gz$')
+
+
+def dropbox_content_hash(data: bytes) -> str:
+    """
+    Dropbox content_hash of some bytes: the sha256 of the concatenated sha256
+    digests of every 4 MB block.
+    """
+    block_hashes = b''.join(hashlib.sha256(data[i:i + DROPBOX_HASH_BLOCK_SIZE]).digest()
+                            for i in range(0, len(data), DROPBOX_HASH_BLOCK_SIZE))
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+class DeltaSync:
+    """
+    Mirror of the ad journal of an AdStore in a dropbox folder.
+
+    The folder holds a gzipped full snapshot (snapshot-<seq>.jsonl.gz) and the
+    gzipped delta segments appended to the journal after it (segment-<seq>.jsonl.gz),
+    numbered by one sequence. A push only uploads the journal records written since
+    the last push, and nothing at all when there are none; a new snapshot replaces
+    the segments every snapshot_every segments. A pull only downloads what comes
+    after the last sequence number the local store has.
+
+    The sequence number and the pushed journal offset are kept next to the store
+    (ads.db -> ads.sync.json).
+    """
+
+    def __init__(self, fs, ad_store, remote_dir, snapshot_every=100):
+        self.fs = fs
+        self.ad_store = ad_store
+        self.remote_dir = remote_dir.rstrip('/')
+        self.snapshot_every = snapshot_every
+        self.state_path = ad_store.filepath.with_suffix('.sync.json')
+        self.state = {'seq': 0, 'offset': 0, 'segments': 0, 'snapshot': None}
+        if self.state_path.exists():
+            self.state.update(json.loads(self.state_path.read_text()))
+
+    def save_state(self):
+        self.state_path.write_text(json.dumps(self.state))
+
+    def snapshot_fingerprint(self):
+        # Changes whenever the journal is compacted into a new snapshot
+        snapshot_path = self.ad_store.journal.snapshot_path
+        if not snapshot_path.exists():
+            return None
+        stat = snapshot_path.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def remote_files(self):
+        """
+        :return: dicts of sequence number -> path of the remote snapshots and segments
+        """
+        snapshots, segments = {}, {}
+        for info in self.fs.ls(self.remote_dir, detail=True) or []:
+            name = info['name']
+            for pattern, files in ((SNAPSHOT_RE, snapshots), (SEGMENT_RE, segments)):
+                match = pattern.search(name)
+                if match:
+                    files[int(match.group(1))] = name
+        return snapshots, segments
+
+    def upload(self, path, data: bytes, check=False):
+        """
+        Upload data to path. With check, only if dropbox doesn't already have the
+        same content there, for files that can be written again under the same
+        name. A new segment is never there yet, checking would cost a request.
+
+        :return: number of bytes uploaded
+        """
+        if check:
+            try:
+                if self.fs.info(path).get('content_hash') == dropbox_content_hash(data):
+                    log.debug(f'{path} is up to date, skipping upload')
+                    return 0
+            except Exception:
+                pass
+        with profiling.stage('upload'):
+            start = time.perf_counter()
+            with self.fs.open(path, mode='wb') as f:
+                f.write(data)
+        metrics.UPLOAD_SECONDS.observe(time.perf_counter() - start)
+        metrics.UPLOAD_BYTES.inc(len(data))
+        return len(data)
+
+    def push(self):
+        """
+        Upload the journal records written since the last push.
+
+        :return: number of bytes uploaded
+        """
+        journal = self.ad_store.journal
+        journal.flush()
+        uploaded = 0
+        if self.snapshot_fingerprint() != self.state['snapshot']:
+            # The journal was compacted since the last push, the records that were
+            # not pushed yet are only in the snapshot
+            uploaded += self.push_snapshot()
+        elif self.state['segments'] >= self.snapshot_every:
+            self.ad_store.compact()
+            uploaded += self.push_snapshot()
+
+        size = journal.size()
+        if size > self.state['offset']:
+            with journal.filepath.open(mode='rb') as f:
+                f.seek(self.state['offset'])
+                records = f.read(size - self.state['offset'])
+            seq = self.state['seq'] + 1
+            uploaded += self.upload(f'{self.remote_dir}/segment-{seq:08d}.jsonl.gz', gzip.compress(records, mtime=0))
+            self.state.update(seq=seq, offset=size, segments=self.state['segments'] + 1)
+            log.info(f'Pushed {len(records)} bytes of ad records as segment {seq}')
+        else:
+            log.info('No new ad records to push')
+        self.save_state()
+        return uploaded
+
+    def push_snapshot(self):
+        snapshot_path = self.ad_store.journal.snapshot_path
+        seq = self.state['seq'] + 1
+        # The snapshot of a push that failed before its state was saved is
+        # pushed again under the same name, often with the same content
+        uploaded = self.upload(f'{self.remote_dir}/snapshot-{seq:08d}.jsonl.gz',
+                               gzip.compress(snapshot_path.read_bytes(), mtime=0), check=True)
+        log.info(f'Pushed ad snapshot {seq} ({uploaded} bytes)')
+        # The snapshot holds every record of the older snapshots and segments
+        snapshots, segments = self.remote_files()
+        for old_seq, path in list(snapshots.items()) + list(segments.items()):
+            if old_seq < seq:
+                self.fs.rm(path)
+        self.state.update(seq=seq, offset=0, segments=0, snapshot=self.snapshot_fingerprint())
+        return uploaded
+
+    def pull(self):
+        """
+        Apply the remote snapshot and segments that are newer than the local store.
+
+        :return: number of records applied
+        """
+        snapshots, segments = self.remote_files()
+        seq = self.state['seq']
+        to_apply = []
+        latest_snapshot = max(snapshots, default=0)
+        if latest_snapshot > seq:
+            to_apply.append(snapshots[latest_snapshot])
+            seq = latest_snapshot
+        to_apply += [segments[s] for s in sorted(segments) if s > seq]
+
+        count = 0
+        for path in to_apply:
+            lines = gzip.decompress(self.fs.cat_file(path)).decode().splitlines()
+            count += self.ad_store.apply(json.loads(line) for line in lines if line.strip())
+            log.info(f'Pulled {len(lines)} ad records from {path}')
+        self.state['seq'] = max([seq] + list(segments))
+        self.save_state()
+        return count
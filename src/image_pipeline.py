@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class ImagePipeline:
+    """
+    Bounded pool of image transfers to a storage backend, e.g. ArtefactStore.save.
+
+    The transfers of different images, and of different ads, run side by side
+    while the ads are sent.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image')
+        self.futures = []
+
+    def run(self, fn, *args):
+        """
+        Queue a transfer. fn returns None when the transfer failed.
+
+        :return: future of the result of fn
+        """
+        future = self.executor.submit(fn, *args)
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Wait for every queued transfer.
+
+        :return: number of images delivered and number of failures
+        """
+        futures, self.futures = self.futures, []
+        wait(futures)
+        delivered = sum(f.result() is not None for f in futures)
+        return delivered, len(futures) - delivered
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
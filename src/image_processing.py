@@ -0,0 +1,93 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Format name of Pillow -> file extension of the stored images
+FORMATS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+THUMBNAIL_EDGE = 256
+THUMBNAIL_QUALITY = 70
+
+
+def encode(image, image_format, quality):
+    out = io.BytesIO()
+    image.save(out, format=image_format, quality=quality, optimize=image_format == 'JPEG')
+    return out.getvalue()
+
+
+def process_image(data, max_edge, image_format, quality, thumbnail_edge):
+    """
+    Downscale an image to max_edge pixels on its longest edge, re-encode it and
+    make its thumbnail. Runs in the worker processes of ImageProcessor.
+
+    :return: (image bytes, thumbnail bytes, CPU seconds spent)
+    """
+    from PIL import Image
+    start = time.process_time()
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGB')
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    resized = encode(image, image_format, quality)
+    image.thumbnail((thumbnail_edge, thumbnail_edge), Image.LANCZOS)
+    thumbnail = encode(image, image_format, THUMBNAIL_QUALITY)
+    return resized, thumbnail, time.process_time() - start
+
+
+class ImageProcessor:
+    """
+    Downscales and re-encodes the images of the ads before they are stored, and
+    makes their thumbnails.
+
+    The images are decoded and encoded by a pool of worker processes, started
+    on the first image, so that the CPU work doesn't hold the GIL of the
+    threads sending the ads. An image is only replaced when the result is
+    smaller than the original.
+    """
+
+    def __init__(self, max_edge=1280, image_format='JPEG', quality=80, thumbnail_edge=THUMBNAIL_EDGE,
+                 max_workers=None):
+        image_format = image_format.upper()
+        if image_format not in FORMATS:
+            raise ValueError(f'image_format must be one of {list(FORMATS)}, not {image_format}')
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.thumbnail_edge = thumbnail_edge
+        self.max_workers = max_workers or min(2, os.cpu_count() or 1)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    @property
+    def extension(self):
+        return FORMATS[self.image_format]
+
+    @property
+    def variant(self):
+        # Suffix of the stored images, an image processed with other settings is stored again
+        return f'-{self.max_edge}q{self.quality}'
+
+    def process(self, data):
+        """
+        Process an image in a worker process, waiting for the result.
+
+        :param data: bytes of the original image
+        :return: (image bytes, thumbnail bytes, CPU seconds spent), the image
+            bytes are None when re-encoding doesn't make it smaller, the
+            original is kept as it is
+        """
+        with self.lock:
+            if self.executor is None:
+                # Forking a process with running threads may copy held locks
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        image, thumbnail, cpu_seconds = self.executor.submit(
+            process_image, data, self.max_edge, self.image_format, self.quality, self.thumbnail_edge).result()
+        return (image if len(image) < len(data) else None), thumbnail, cpu_seconds
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
@@ -0,0 +1,140 @@
+import json
+import os
+import re
+from json import JSONDecodeError
+from pathlib import Path
+
+from loguru import logger as log
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def read_json_items(txt):
+    """
+    Read the items of a JSON object that were written completely, e.g. from a file
+    that was cut off while being written. Single pass over the text.
+
+    :param txt: text of a JSON object, possibly truncated
+    :return: dict of the complete items
+    """
+    decoder = json.JSONDecoder()
+    res = {}
+    pos = _WHITESPACE.match(txt, 0).end()
+    if txt[pos:pos + 1] != '{':
+        return res
+    pos += 1
+    while True:
+        try:
+            pos = _WHITESPACE.match(txt, pos).end()
+            key, pos = decoder.raw_decode(txt, pos)
+            pos = _WHITESPACE.match(txt, pos).end()
+            if txt[pos:pos + 1] != ':':
+                break
+            pos = _WHITESPACE.match(txt, pos + 1).end()
+            value, pos = decoder.raw_decode(txt, pos)
+        except JSONDecodeError:
+            break
+        res[key] = value
+        pos = _WHITESPACE.match(txt, pos).end()
+        if txt[pos:pos + 1] != ',':
+            break
+        pos += 1
+    return res
+
+
+class AdJournal():
+    """
+    Append-only JSON lines log of ad records, one {"id", "info", "sent_at", "t"}
+    object per line, next to a snapshot file in the same format.
+
+    Recording an ad appends a single line. A crash can only tear the last line,
+    which is dropped when the journal is opened. compact() folds the journal into
+    a new snapshot once it grows past compact_bytes.
+    """
+
+    def __init__(self, filepath, compact_bytes=8 * 1024 * 1024):
+        self.filepath = Path(filepath)
+        self.snapshot_path = self.filepath.with_name(self.filepath.stem + '.snapshot.jsonl')
+        self.compact_bytes = compact_bytes
+        self.pending = []
+        self.recover()
+
+    def recover(self):
+        # Drop a torn last line, only the end of the file needs to be read
+        if not self.filepath.exists():
+            return
+        with self.filepath.open(mode='rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            f.seek(end - 1)
+            if f.read(1) == b'\n':
+                return
+            # Walk back to the end of the last complete line
+            pos = end
+            while pos > 0:
+                start = max(0, pos - 4096)
+                f.seek(start)
+                newline = f.read(pos - start).rfind(b'\n')
+                if newline >= 0:
+                    pos = start + newline + 1
+                    break
+                pos = start
+            log.warning(f'Dropping {end - pos} bytes of a torn record at the end of {self.filepath}')
+            f.truncate(pos)
+
+    def append(self, record):
+        self.pending.append(json.dumps(record))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.filepath.open(mode='a') as f:
+            f.write('\n'.join(self.pending) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def size(self):
+        return self.filepath.stat().st_size if self.filepath.exists() else 0
+
+    def needs_compaction(self):
+        return self.size() > self.compact_bytes
+
+    def replay(self):
+        """
+        Stream the records of the snapshot, then of the journal, in the order they
+        were written. Lines that can't be parsed are skipped.
+        """
+        for path in (self.snapshot_path, self.filepath):
+            if not path.exists():
+                continue
+            with path.open(mode='r') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except JSONDecodeError:
+                        log.warning(f'Skipping unreadable record at {path}:{line_number}')
+
+    def compact(self, records):
+        """
+        Replace the snapshot with the given records and empty the journal.
+
+        :param records: iterable of every current record, e.g. streamed from the store
+        """
+        self.flush()
+        tmp_path = self.snapshot_path.with_suffix('.tmp')
+        count = 0
+        with tmp_path.open(mode='w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Records still in the journal are also in the snapshot, replaying both is harmless
+        self.filepath.open(mode='w').close()
+        log.info(f'Compacted {count} ad records into {self.snapshot_path}')
+        return count
@@ -0,0 +1,439 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger as log
+
+from ad_journal import AdJournal, read_json_items
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ads (
+    id TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    updated REAL NOT NULL,
+    sent_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ads_sent_at ON ads (sent_at);
+CREATE INDEX IF NOT EXISTS ads_first_seen ON ads (first_seen);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    sent_at TEXT NOT NULL,
+    PRIMARY KEY (id, chat_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS excluded_ads (
+    id TEXT NOT NULL,
+    search TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (id, search)
+) WITHOUT ROWID;
+"""
+
+# Info of an ad past the retention period, only its id is kept to skip it
+TOMBSTONE = '{}'
+# Fields of the ads as they are sent that are not stored: the id is the key and
+# the sent time is kept in sent_at
+TRANSIENT_FIELDS = ('Id', 'time_sent', 'is_business')
+
+
+def image_html(data_source):
+    return '<img src ="' + data_source + '"/>'
+
+
+def compact_info(info):
+    """
+    :return: the info to store, without the transient fields and without the
+        Image HTML when it can be rebuilt from DataSource
+    """
+    info = {key: value for key, value in info.items() if key not in TRANSIENT_FIELDS}
+    if 'DataSource' in info and info.get('Image') == image_html(info['DataSource']):
+        del info['Image']
+    return info
+
+
+def expand_info(info):
+    """
+    :return: the info as the scraper found it, from the stored info
+    """
+    if 'DataSource' in info and 'Image' not in info:
+        info['Image'] = image_html(info['DataSource'])
+    return info
+
+
+class AdStore():
+    """
+    Ads found by the scraper and their sent state, stored in SQLite.
+
+    Behaves like the dict of ad id -> ad info that used to be loaded from
+    ads.json, but every lookup and update only touches the ads involved, so a
+    run costs time proportional to the number of new ads, not to the history.
+    Changes are written in a transaction that is committed with commit().
+
+    A file backed store also appends every change to an AdJournal next to the
+    SQLite file (ads.db -> ads.jsonl), the plain text copy of the ads that is
+    mirrored to Dropbox and replayed to rebuild a lost store.
+
+    Ads are stored without the fields that can be rebuilt (see compact_info),
+    the sent state of an ad is only its sent time, and expire() reduces the ads
+    past a retention period to tombstones that only keep the id, so the
+    history grows by a few bytes per ad once the ads expire.
+
+    An ad sent to several chats is recorded as sent once every chat has it.
+    Until then, mark_delivered() records the chats it was delivered to, so a
+    chat that failed gets the ad again without the others getting it twice.
+    The deliveries are local to the SQLite file, they are not journaled.
+
+    The ads a search skipped for its exclude list are not stored as ads, the
+    same ad may be wanted by another search, but mark_excluded() records them
+    per search, also locally, so they don't count as new ads on the next run.
+
+    Safe to share between threads, e.g. a crawler thread looking up the known
+    ads while the main thread stores the new ones: every access to the
+    connection holds a lock.
+    """
+
+    def __init__(self, filename=None, journal=True):
+        self.filepath = Path(filename) if filename else None
+        self.db = sqlite3.connect(str(self.filepath) if self.filepath else ':memory:',
+                                  check_same_thread=False)
+        if self.filepath:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # Reentrant, mark_sent and commit call the other locked methods
+        self.lock = threading.RLock()
+        self.journal = AdJournal(self.filepath.with_suffix('.jsonl')) if self.filepath and journal else None
+        if self.journal and self.is_empty():
+            self.restore()
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Open the store at filename. A legacy ads JSON file is imported once into
+        a SQLite file next to it, which is used from then on.
+
+        :param filename: path of the SQLite file, or of a legacy ads JSON file
+        :return: AdStore
+        """
+        filepath = Path(filename)
+        if filepath.suffix != '.json':
+            return cls(filepath)
+
+        db_path = filepath.with_suffix('.db')
+        if db_path.exists():
+            return cls(db_path)
+        store = cls(db_path)
+        if filepath.exists() and filepath.stat().st_size > 0:
+            with filepath.open(mode='r') as ads_file:
+                store.import_ads(load_json_dict(ads_file.read()))
+            store.commit()
+            log.info(f'Imported {len(store)} ads from {filepath} into {db_path}')
+        return store
+
+    def __contains__(self, ad_id):
+        return self.__fetchone('SELECT 1 FROM ads WHERE id = ?', (ad_id,)) is not None
+
+    def __getitem__(self, ad_id):
+        row = self.__fetchone('SELECT info FROM ads WHERE id = ?', (ad_id,))
+        if row is None:
+            raise KeyError(ad_id)
+        return expand_info(json.loads(row[0]))
+
+    def __setitem__(self, ad_id, info):
+        self.upsert(ad_id, info)
+
+    def __len__(self):
+        return self.__fetchone('SELECT COUNT(*) FROM ads')[0]
+
+    def __iter__(self):
+        with self.lock:
+            return iter([row[0] for row in self.db.execute('SELECT id FROM ads')])
+
+    def is_empty(self):
+        return self.__fetchone('SELECT 1 FROM ads LIMIT 1') is None
+
+    def get(self, ad_id, default=None):
+        try:
+            return self[ad_id]
+        except KeyError:
+            return default
+
+    def upsert(self, ad_id, info, sent_at=None):
+        """
+        Insert an ad or update the info of an ad already in the store. The first
+        seen time of an existing ad is kept, as is its sent time unless one is given.
+        """
+        now = time.time()
+        info = compact_info(info)
+        with self.lock:
+            self.__write(ad_id, info, sent_at, now)
+            if self.journal:
+                self.journal.append({'id': ad_id, 'info': info, 'sent_at': sent_at, 't': now})
+
+    def __write(self, ad_id, info, sent_at, now):
+        if info is None:
+            # Sent time only, see mark_sent. An ad the store doesn't have is kept as a tombstone
+            self.db.execute(
+                'INSERT INTO ads (id, info, first_seen, updated, sent_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET updated = excluded.updated, '
+                'sent_at = COALESCE(excluded.sent_at, ads.sent_at)',
+                (ad_id, TOMBSTONE, now, now, sent_at))
+            return
+        self.db.execute(
+            'INSERT INTO ads (id, info, first_seen, updated, sent_at) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET info = excluded.info, updated = excluded.updated, '
+            'sent_at = COALESCE(excluded.sent_at, ads.sent_at)',
+            (ad_id, json.dumps(info), now, now, sent_at))
+
+    def unsent(self):
+        """
+        :return: dict of ad id -> ad info of the ads that were not sent yet, with
+            the id added as the Id field
+        """
+        ads = {}
+        with self.lock:
+            rows = self.db.execute('SELECT id, info FROM ads WHERE sent_at IS NULL AND info != ? '
+                                   'ORDER BY first_seen', (TOMBSTONE,)).fetchall()
+        for ad_id, info in rows:
+            ads[ad_id] = expand_info(json.loads(info))
+            ads[ad_id]['Id'] = ad_id
+        return ads
+
+    def is_sent(self, ad_id):
+        row = self.__fetchone('SELECT sent_at FROM ads WHERE id = ?', (ad_id,))
+        return row is not None and row[0] is not None
+
+    def sent_count(self):
+        return self.__fetchone('SELECT COUNT(*) FROM ads WHERE sent_at IS NOT NULL')[0]
+
+    def mark_sent(self, ad_id, ad):
+        """
+        Record an ad as sent. Only the sent time is written, the info of the ad is
+        already in the store. Committed right away so an interrupted run does not
+        send it again.
+        """
+        sent_at = ad.get('time_sent') or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            if ad_id not in self:
+                self.upsert(ad_id, ad, sent_at=sent_at)
+            else:
+                now = time.time()
+                self.__write(ad_id, None, sent_at, now)
+                if self.journal:
+                    self.journal.append({'id': ad_id, 'info': None, 'sent_at': sent_at, 't': now})
+            # The chats it was delivered to are only needed until the ad is sent
+            self.db.execute('DELETE FROM deliveries WHERE id = ?', (ad_id,))
+            self.commit()
+
+    def mark_delivered(self, ad_id, chat_id, sent_at):
+        """
+        Record an ad as delivered to one of its chats, committed right away
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO deliveries (id, chat_id, sent_at) VALUES (?, ?, ?)',
+                            (ad_id, chat_id, sent_at))
+            self.db.commit()
+
+    def delivered_chats(self, ad_id):
+        """
+        :return: set of the chats an ad that is not sent yet was delivered to
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT chat_id FROM deliveries WHERE id = ?', (ad_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_excluded(self, ad_id, search):
+        """
+        Record an ad as excluded by the exclude list of a search
+        """
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO excluded_ads (id, search, first_seen) VALUES (?, ?, ?)',
+                            (ad_id, search, time.time()))
+
+    def is_excluded(self, ad_id, search):
+        return self.__fetchone('SELECT 1 FROM excluded_ads WHERE id = ? AND search = ?', (ad_id, search)) is not None
+
+    def import_ads(self, ads, sent=False):
+        """
+        Import a dict of ad id -> ad info, e.g. loaded from the legacy ads.json or
+        sent_ads.json files.
+
+        :param ads: dict of ad id -> ad info
+        :param sent: mark the imported ads as sent
+        """
+        for ad_id, info in ads.items():
+            sent_at = (info.get('time_sent') or '') if sent else None
+            self.upsert(ad_id, info, sent_at=sent_at)
+
+    def export(self, sent=False):
+        """
+        :param sent: export the sent ads only
+        :return: dict of ad id -> ad info in the format of the legacy JSON files
+        """
+        query = 'SELECT id, info FROM ads' + (' WHERE sent_at IS NOT NULL' if sent else '')
+        with self.lock:
+            rows = self.db.execute(query).fetchall()
+        return {ad_id: expand_info(json.loads(info)) for ad_id, info in rows}
+
+    def records(self):
+        """
+        Stream every ad as a journal record, in the order they were first seen
+        """
+        with self.lock:
+            cursor = self.db.execute('SELECT id, info, first_seen, sent_at FROM ads ORDER BY first_seen')
+        while True:
+            # The lock is only held to read each batch
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for ad_id, info, first_seen, sent_at in rows:
+                yield {'id': ad_id, 'info': json.loads(info), 'sent_at': sent_at, 't': first_seen}
+
+    def restore(self):
+        """
+        Replay the journal into the store, e.g. to rebuild a lost SQLite file.
+
+        :return: number of records replayed
+        """
+        count = self.apply(self.journal.replay())
+        if count:
+            log.info(f'Restored {count} ad records from {self.journal.filepath}')
+        return count
+
+    def apply(self, records):
+        """
+        Write journal records, e.g. pulled from a mirror, to the store without
+        adding them to the journal again.
+
+        :param records: iterable of journal records
+        :return: number of records applied
+        """
+        count = 0
+        with self.lock:
+            for record in records:
+                info = record.get('info')
+                self.__write(record['id'], compact_info(info) if info is not None else None,
+                             record.get('sent_at'), record.get('t', time.time()))
+                count += 1
+            self.db.commit()
+        return count
+
+    def expire(self, max_age_days):
+        """
+        Reduce the ads first seen more than max_age_days ago to tombstones. The id
+        and sent time of an expired ad are kept, so it is still skipped when it
+        shows up again, and it is never sent once expired.
+
+        :return: number of ads expired
+        """
+        cutoff = time.time() - max_age_days * 24 * 3600
+        with self.lock:
+            expired = self.db.execute('SELECT id, sent_at FROM ads WHERE first_seen < ? AND info != ?',
+                                      (cutoff, TOMBSTONE)).fetchall()
+            now = time.time()
+            self.db.execute('UPDATE ads SET info = ?, updated = ? WHERE first_seen < ? AND info != ?',
+                            (TOMBSTONE, now, cutoff, TOMBSTONE))
+            if self.journal:
+                for ad_id, sent_at in expired:
+                    self.journal.append({'id': ad_id, 'info': {}, 'sent_at': sent_at, 't': now})
+            self.db.execute('DELETE FROM excluded_ads WHERE first_seen < ?', (cutoff,))
+        if expired:
+            log.info(f'Expired {len(expired)} ads first seen more than {max_age_days} days ago')
+        return len(expired)
+
+    def compact(self, rewrite=False):
+        """
+        Fold the journal into a snapshot of the current ads
+
+        :param rewrite: also store every ad again in the compact format, e.g. a
+            store written before it, and give the free space of the SQLite file
+            back to the file system
+        """
+        with self.lock:
+            if rewrite:
+                rows = self.db.execute('SELECT id, info FROM ads WHERE info != ?', (TOMBSTONE,)).fetchall()
+                self.db.executemany('UPDATE ads SET info = ? WHERE id = ?',
+                                    ((json.dumps(compact_info(json.loads(info))), ad_id) for ad_id, info in rows))
+            self.db.commit()
+            if self.journal:
+                self.journal.compact(self.records())
+            if rewrite:
+                self.db.execute('VACUUM')
+                if self.filepath:
+                    self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def size(self):
+        """
+        :return: bytes of the SQLite file and of its write-ahead log
+        """
+        paths = [self.filepath, self.filepath.with_name(self.filepath.name + '-wal')] if self.filepath else []
+        return sum(path.stat().st_size for path in paths if path.exists())
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            if self.journal:
+                self.journal.flush()
+                if self.journal.needs_compaction():
+                    self.compact()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+    def __fetchone(self, query, params=()):
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
+
+
+def load_json_dict(txt):
+    """
+    Parse a JSON object, keeping its complete items if the text is cut off
+    """
+    try:
+        return json.loads(txt)
+    except json.JSONDecodeError:
+        ads = read_json_items(txt)
+        log.warning(f'Invalid JSON, recovered {len(ads)} complete items')
+        return ads
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import the legacy ads JSON files into a SQLite ad store, expire and compact a store")
+    parser.add_argument('db', metavar='File path', help="SQLite file of the ad store, created if it doesn't exist")
+    parser.add_argument('--ads', metavar='File path', nargs='+', default=[],
+                        help="ads.json / config_ads.json files with the ads found by the scraper")
+    parser.add_argument('--sent', metavar='File path', nargs='+', default=[],
+                        help="sent_ads.json files with the ads already sent")
+    parser.add_argument('--retention-days', metavar='N', type=int, default=0,
+                        help="Only keep the id and sent time of the ads first seen more than N days ago")
+    parser.add_argument('--compact', action='store_true',
+                        help="Store every ad in the compact format, fold the journal and shrink the SQLite file")
+    args = parser.parse_args()
+
+    store = AdStore(args.db)
+    for filepath, sent in [(f, False) for f in args.ads] + [(f, True) for f in args.sent]:
+        with open(filepath, 'r') as ads_file:
+            ads = load_json_dict(ads_file.read())
+        store.import_ads(ads, sent=sent)
+        print("Imported %s ads from %s" % (len(ads), filepath))
+    if args.retention_days:
+        print("Expired %s ads" % store.expire(args.retention_days))
+    store.commit()
+    if args.compact:
+        size = store.size()
+        store.compact(rewrite=True)
+        print("Compacted %s from %s KB to %s KB" % (args.db, size // 1024, store.size() // 1024))
+    print("%s ads in %s, %s sent" % (len(store), args.db, store.sent_count()))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,32 +3,85 @@ from email.mime.text import MIMEText
 
 
 class EmailClient():
+    """
+    Sends the new ads by email over one SMTP session, opened on the first email
+    and kept for the next ones until close(). A session the server dropped in
+    between is opened again once.
+    """
 
-    def __init__(self, email_config):
+    def __init__(self, email_config, timeout=30):
         self.from_email = email_config.get("from")
         self.username = email_config.get("username")
         self.password = email_config.get("password")
         self.receiver = email_config.get("receiver")
         self.smtp_server = email_config.get("smtp server")
         self.smtp_port = email_config.get("smtp port")
+        self.timeout = timeout
+        self.server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Opens and authenticates the SMTP session
+    def connect(self):
+        self.server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        self.server.ehlo()
+        self.server.login(self.username, self.password)
+
+    # Ends the SMTP session, if one is open
+    def close(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The server already dropped the session
+            pass
+        finally:
+            server.close()
+
+    # Sends a message over the open session, reconnecting once if it was dropped.
+    # Other SMTP errors, e.g. a refused recipient, are raised without sending again
+    def send(self, msg):
+        for attempt in range(2):
+            if self.server is None:
+                self.connect()
+            try:
+                self.server.send_message(msg)
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
 
     # Sends an email with links and info of new ads
     def mail_ads(self, ad_dict, email_title):
         subject = self.__create_email_subject(email_title, len(ad_dict))
-        body = self.__create_email_body(ad_dict)
-
+        self.send(self.__create_message(subject, self.__create_email_body([(None, ad_dict)])))
+
+    # Sends one email with the new ads of several searches, a list of (email title, ad dict)
+    def mail_digest(self, searches):
+        searches = [(email_title, ad_dict) for email_title, ad_dict in searches if ad_dict]
+        if not searches:
+            return
+        ad_count = sum(len(ad_dict) for _, ad_dict in searches)
+        if len(searches) == 1:
+            subject = self.__create_email_subject(searches[0][0], ad_count)
+        else:
+            titles = ', '.join(email_title for email_title, _ in searches if email_title)
+            subject = str(ad_count) + ' New Ads Found! ' + titles
+        self.send(self.__create_message(subject, self.__create_email_body(searches, headings=len(searches) > 1)))
+
+    def __create_message(self, subject, body):
         msg = MIMEText(body, 'html')
         msg['Subject'] = subject
         msg['From'] = self.from_email
         msg['To'] = self.receiver
-
-        server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
-
-        server.ehlo()
-        server.login(self.username, self.password)
-        server.send_message(msg)
-
-        server.quit()
+        return msg
 
     def __create_email_subject(self, email_title, ad_count):
         if ad_count > 1:
@@ -36,34 +89,30 @@ class EmailClient():
 
         return 'One New ' + email_title + ' Ad Found!'
 
-    def __create_email_body(self, ad_dict):
-        body = '<!DOCTYPE html> \n<html> \n<body>'
-        try:
+    # Renders the ads of each (email title, ad dict) in one pass, the parts are joined once at the end
+    def __create_email_body(self, searches, headings=False):
+        parts = ['<!DOCTYPE html> \n<html> \n<body>']
+        for email_title, ad_dict in searches:
+            if headings:
+                parts.append('<h2>' + (email_title or '') + '</h2>')
             for ad_id in ad_dict:
-                body += '<p><b>' + ad_dict[ad_id]['Title'] + '</b>' + \
-                    ' - ' + ad_dict[ad_id]['Location']
-
-                if ad_dict[ad_id]['Date'] != "":
-                    body += ' - ' + ad_dict[ad_id]['Date']
-                body += '<br /></p>'
+                parts.append(self.__create_ad_html(ad_dict[ad_id]))
 
-                body += '<a href="' + ad_dict[ad_id]['Url'] + '">'
+        parts.append('<p>This is an automated message, \
+            please do not reply to this message.</p>')
 
-                body += ad_dict[ad_id]['Image'] + '</a>'
+        return ''.join(parts)
 
-                body += '<p>' + ad_dict[ad_id]['Description'] + '<br />'
-
-                if ad_dict[ad_id]['Details'] != '':
-                    body += ad_dict[ad_id]['Details'] + '<br />'
-
-                body += ad_dict[ad_id]['Price'] + \
-                    '<br /><br /><br /><br /></p>'
-
-        except KeyError:
-            body += '<p>' + ad_dict[ad_id]['Title'] + '<br />'
-            body += ad_dict[ad_id]['Url'] + '<br /><br />' + '</p>'
-
-        body += '<p>This is an automated message, \
-            please do not reply to this message.</p>'
-
-        return body
+    # An ad that misses fields only gets its title and link
+    def __create_ad_html(self, ad):
+        try:
+            return ''.join((
+                '<p><b>', ad['Title'], '</b>', ' - ', ad['Location'],
+                ' - ' + ad['Date'] if ad['Date'] != "" else '',
+                '<br /></p>',
+                '<a href="', ad['Url'], '">', ad['Image'], '</a>',
+                '<p>', ad['Description'], '<br />',
+                ad['Details'] + '<br />' if ad['Details'] != '' else '',
+                ad['Price'], '<br /><br /><br /><br /></p>'))
+        except (KeyError, TypeError):
+            return '<p>' + str(ad.get('Title')) + '<br />' + str(ad.get('Url')) + '<br /><br />' + '</p>'
@@ -0,0 +1,100 @@
+import re
+
+PHONE_NUMBER_RE = re.compile(r'(\d{3}[-\.\s]??\d{3}[-\.\s]??\d{4}|\(\d{3}\)\s*\d{3}[-\.\s]??\d{4}|\d{3}[-\.\s]??\d{4})')
+EMAIL_ADDRESS_RE = re.compile(r'[\w\.-]+@[\w\.-]+')
+NON_DIGIT_RE = re.compile(r'\D')
+
+# Characters that nltk.word_tokenize always splits off the surrounding word
+_SPLIT_CHARS = '\\s"“”‘’«»„`;@#$%&?!*()\\[\\]{}<>‒-―'
+# The ones it has already split off when it looks for a quote before a space
+_EARLY_SPLIT_CHARS = ' «“‘„`;@#$%&?!‒-―'
+# A period is split off at the end of a sentence, maybe followed by closing
+# brackets and quotes. A double quote, or two quotes, after a space is an
+# opening quote by then
+_CLOSING = r"""(?:[\])}>»”’ ]|(?<! )["']|(?<= )'(?!'))"""
+_FINAL_PERIOD = rf"(?:\.(?:\s|{_CLOSING}*\s*$))"
+# What starts a new token after a word: a split character, a comma or colon
+# not followed by a digit, a final period, an ellipsis, a double dash or two
+# quotes
+_NEXT_TOKEN = rf"(?:$|[{_SPLIT_CHARS}]|[,:](?!\d)|{_FINAL_PERIOD}|\.\.|--|'')"
+_EARLY_NEXT_TOKEN = rf"(?:[{_EARLY_SPLIT_CHARS}]|[,:](?!\d)|{_FINAL_PERIOD}|\.\.)"
+# Clitics are split off in two passes, first 's, 'm, 'd and a bare quote, then
+# 'll, 're, 've and n't, each only before a space
+_CLITIC_1 = r"'(?:s|m|d)?"
+_CLITIC_2 = r"(?:'(?:ll|re|ve)|n't)"
+_CLITIC_1_END = rf"(?:{_CLITIC_1}(?:{_NEXT_TOKEN}|'{_EARLY_NEXT_TOKEN}))"
+# A word token starts after one of the split characters, after an ellipsis or
+# after a quote that opens a word. Runs of commas and colons, of dashes and of
+# quotes are split off in pairs from their start, so the word also starts
+# after an odd run of commas and colons or an even run of dashes or quotes,
+# which the pattern consumes
+_TOKEN_START = (rf"(?:^|(?<=[{_SPLIT_CHARS}])|(?<=\.\.)|(?<=(?<!\w)')(?!(?:re|ve|ll|m|t|s|d|n)\b)"
+                rf"|(?=[,:])(?<![,:])(?:[,:]{{2}})*[,:](?!\d)|(?=--)(?<!-)(?:--)+|(?='')(?<!')(?:'')+)")
+# A word token ends before a new token or before the clitics split off before
+# it: one of the first pass, maybe followed by a quote split off early, maybe
+# after one of the second pass
+_TOKEN_END = rf"(?={_NEXT_TOKEN}|{_CLITIC_1_END}|{_CLITIC_2}(?:{_NEXT_TOKEN}|{_CLITIC_1_END}))"
+_SPLIT_CHAR_RE = re.compile(rf"[{_SPLIT_CHARS},:]")
+
+
+class ExcludeMatcher():
+    """
+    Exclude list compiled into a single regular expression.
+
+    Matches the same ads as tokenizing the text with nltk.word_tokenize and
+    comparing every exclude word with the tokens: single words only match whole
+    word tokens, phrases of several words match anywhere in the text, phone
+    numbers match whatever their formatting and email addresses match whole
+    addresses.
+    """
+
+    def __init__(self, exclude_words):
+        words, phrases, emails = set(), set(), set()
+        self.phone_numbers = set()
+        for word in exclude_words:
+            word = word.lower()
+            if len(word.split()) > 1:
+                phrases.add(word)
+            elif '@' in word:
+                emails.add(word)
+            elif word and not _SPLIT_CHAR_RE.search(word):
+                # A word containing split characters can never be a token
+                words.add(word)
+                if word.isdigit():
+                    self.phone_numbers.add(word)
+
+        alternatives = []
+        if phrases:
+            alternatives.append(self.__alternation(phrases))
+        if words:
+            alternatives.append(_TOKEN_START + '(?P<word>' + self.__alternation(words) + ')' + _TOKEN_END)
+        if emails:
+            alternatives.append(r'(?<![\w\.-])' + self.__alternation(emails) + r'(?![\w\.-])')
+        self.pattern = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def __bool__(self):
+        return self.pattern is not None
+
+    def search(self, text):
+        """
+        Find an exclude word in a lower-case text.
+
+        :param text: lower-case text of the ad
+        :return: the exclude word found in the text, None if there is none
+        """
+        if self.pattern is not None:
+            match = self.pattern.search(text)
+            if match:
+                # The start of a word match can include the commas, dashes or quotes before it
+                return match.groupdict().get('word') or match.group(0)
+        if self.phone_numbers:
+            for number in PHONE_NUMBER_RE.findall(text):
+                number = NON_DIGIT_RE.sub('', number)
+                if number in self.phone_numbers:
+                    return number
+        return None
+
+    @staticmethod
+    def __alternation(words):
+        # Longest first, so the reported word is the longest one at a position
+        return '(?:' + '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True)) + ')'
@@ -0,0 +1,222 @@
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from loguru import logger as log
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_CACHE_PATH = Path(tempfile.gettempdir()).joinpath('http_cache.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_kind_accessed_at ON responses (kind, accessed_at);
+"""
+
+
+class CachePolicy():
+    """
+    How the responses of one kind of resource are cached.
+
+    :param ttl: seconds a response is used without asking the server again. A
+        stale response is revalidated with its ETag / Last-Modified when it has one
+    :param max_bytes: size of the responses of this kind kept, the least recently
+        used are evicted past it
+    :param store: cache the responses at all
+    """
+
+    def __init__(self, ttl=0, max_bytes=0, store=True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.store = store
+
+
+# Search result pages change every few minutes, ad detail pages when the ad is
+# edited or sold. Images are streamed to storage by the ImagePipeline and never
+# kept here.
+POLICIES = {
+    'search': CachePolicy(ttl=2 * 60, max_bytes=16 * 1024 * 1024),
+    'detail': CachePolicy(ttl=60 * 60, max_bytes=64 * 1024 * 1024),
+    'image': CachePolicy(store=False),
+}
+
+
+class HttpCache():
+    """
+    GET requests through a SQLite response cache with one CachePolicy per kind
+    of resource, and hit / miss counts and downloaded bytes per kind.
+
+    get() returns a requests.Response, with from_cache set, so callers use
+    cached and fresh responses the same way. Only 200 responses are stored.
+    Safe to share between threads.
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_PATH, policies=None, timeout=30):
+        self.filepath = Path(filename) if filename else None
+        self.policies = policies or POLICIES
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.db = sqlite3.connect(str(self.filepath) if self.filepath else ':memory:',
+                                  check_same_thread=False)
+        if self.filepath:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.stats = {kind: dict.fromkeys(('hits', 'revalidated', 'misses', 'bypassed', 'evicted', 'bytes'), 0)
+                      for kind in self.policies}
+
+    def get(self, url, kind='search'):
+        """
+        :param url: URL to GET
+        :param kind: kind of resource, one of the keys of the policies
+        :return: requests.Response
+        """
+        policy = self.policies[kind]
+        if not policy.store:
+            self.__count(kind, 'bypassed')
+            return self.session.get(url, timeout=self.timeout)
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT status, headers, content, fetched_at FROM responses WHERE url = ?',
+                                  (url,)).fetchone()
+        if row is not None:
+            status, headers, content, fetched_at = row
+            headers = json.loads(headers)
+            if now - fetched_at < policy.ttl:
+                self.__count(kind, 'hits')
+                self.__touch(url, now)
+                return self.__response(url, status, headers, content)
+            validators = self.__validators(headers)
+            if validators:
+                response = self.session.get(url, headers=validators, timeout=self.timeout)
+                if response.status_code == 304:
+                    self.__count(kind, 'revalidated')
+                    with self.lock:
+                        self.db.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?',
+                                        (now, now, url))
+                        self.db.commit()
+                    return self.__response(url, status, headers, content)
+                self.__count(kind, 'misses')
+                self.__store(url, kind, response, now)
+                return response
+
+        self.__count(kind, 'misses')
+        response = self.session.get(url, timeout=self.timeout)
+        self.__store(url, kind, response, now)
+        return response
+
+    def size(self, kind=None):
+        query = 'SELECT COALESCE(SUM(size), 0) FROM responses'
+        with self.lock:
+            if kind:
+                return self.db.execute(query + ' WHERE kind = ?', (kind,)).fetchone()[0]
+            return self.db.execute(query).fetchone()[0]
+
+    def summary(self):
+        """
+        :return: one line of hit / miss counts per kind of resource that was requested
+        """
+        parts = []
+        for kind, stats in self.stats.items():
+            if any(stats.values()):
+                counts = ', '.join(f'{count} {name}' for name, count in stats.items() if count)
+                parts.append(f'{kind}: {counts}')
+        return '; '.join(parts) or 'no requests'
+
+    def close(self):
+        self.session.close()
+        with self.lock:
+            self.db.close()
+
+    def __count(self, kind, name, n=1):
+        with self.lock:
+            self.stats[kind][name] += n
+
+    def __touch(self, url, now):
+        with self.lock:
+            self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+            self.db.commit()
+
+    def __store(self, url, kind, response, now):
+        response.from_cache = False
+        self.__count(kind, 'bytes', len(response.content))
+        if response.status_code != 200:
+            return
+        content = response.content
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (url, kind, status, headers, content, size, fetched_at, '
+                'accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, kind, response.status_code, json.dumps(dict(response.headers)), content, len(content),
+                 now, now))
+            self.__evict(kind)
+            self.db.commit()
+
+    def __evict(self, kind):
+        # Drop the least recently used responses of the kind until it fits its cap
+        max_bytes = self.policies[kind].max_bytes
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses WHERE kind = ?',
+                                (kind,)).fetchone()[0]
+        if total <= max_bytes:
+            return
+        evicted = []
+        for url, size in self.db.execute('SELECT url, size FROM responses WHERE kind = ? ORDER BY accessed_at',
+                                         (kind,)).fetchall():
+            if total <= max_bytes:
+                break
+            evicted.append((url,))
+            total -= size
+        self.db.executemany('DELETE FROM responses WHERE url = ?', evicted)
+        self.stats[kind]['evicted'] += len(evicted)
+        log.debug(f'Evicted {len(evicted)} cached {kind} responses')
+
+    @staticmethod
+    def __validators(headers):
+        headers = CaseInsensitiveDict(headers)
+        validators = {}
+        if 'ETag' in headers:
+            validators['If-None-Match'] = headers['ETag']
+        if 'Last-Modified' in headers:
+            validators['If-Modified-Since'] = headers['Last-Modified']
+        return validators
+
+    @staticmethod
+    def __response(url, status, headers, content):
+        response = requests.Response()
+        response.url = url
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.from_cache = True
+        return response
+
+
+_shared_cache = None
+# Concurrent first uses, e.g. from the crawl threads, must share one cache
+_shared_cache_lock = threading.Lock()
+
+
+def shared_cache():
+    """
+    The HttpCache of the process, opened on first use
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = HttpCache()
+    return _shared_cache
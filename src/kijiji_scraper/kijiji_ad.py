@@ -1,30 +1,32 @@
 
 
 class KijijiAd():
+    # Only plain strings are kept, the listing tree is not referenced once the
+    # fields are read, so the parse tree of the page can be freed
+    __slots__ = ('title', 'id', 'info')
 
     def __init__(self, ad):
         self.title = ad.find('a', {"class": "title"}).text.strip()
         self.id = ad['data-listing-id']
-        self.ad = ad
         self.info = {}
 
-        self.__locate_info()
+        self.__locate_info(ad)
         self.__parse_info()
 
-    def __locate_info(self):
+    def __locate_info(self, ad):
         # Locate ad information
-        self.info["Title"] = self.ad.find('a', {"class": "title"})
-        self.info["Image"] = str(self.ad.find('img'))
-        self.info["Url"] = self.ad.get("data-vip-url")
-        self.info["Details"] = self.ad.find(
+        self.info["Title"] = ad.find('a', {"class": "title"})
+        self.info["Image"] = str(ad.find('img'))
+        self.info["Url"] = ad.get("data-vip-url")
+        self.info["Details"] = ad.find(
             'div', {"class": "details"})
-        self.info["Description"] = self.ad.find(
+        self.info["Description"] = ad.find(
             'div', {"class": "description"})
-        self.info["Date"] = self.ad.find(
+        self.info["Date"] = ad.find(
             'span', {"class": "date-posted"})
-        self.info["Location"] = self.ad.find('div', {"class": "location"})
-        self.info["Price"] = self.ad.find('div', {"class": "price"})
-        self.info["DataSource"] = str(self.ad.find('img').get('data-src'))
+        self.info["Location"] = ad.find('div', {"class": "location"})
+        self.info["Price"] = ad.find('div', {"class": "price"})
+        self.info["DataSource"] = str(ad.find('img').get('data-src'))
 
     def __parse_info(self):
         # Parse Details and Date information
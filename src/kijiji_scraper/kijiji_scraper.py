@@ -1,176 +1,215 @@
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
+from urllib.parse import urlparse
 
-import nltk
 from loguru import logger as log
-import requests
-from bs4 import BeautifulSoup
-import json
-from kijiji_ad import KijijiAd
+import metrics
+import profiling
+from ad_store import AdStore
+from exclude_matcher import ExcludeMatcher, PHONE_NUMBER_RE, EMAIL_ADDRESS_RE, NON_DIGIT_RE
 from pathlib import Path
 
 
 
 def extract_phone_numbers(string):
-    r = re.compile(r'(\d{3}[-\.\s]??\d{3}[-\.\s]??\d{4}|\(\d{3}\)\s*\d{3}[-\.\s]??\d{4}|\d{3}[-\.\s]??\d{4})')
-    phone_numbers = r.findall(string)
-    return [re.sub(r'\D', '', number) for number in phone_numbers]
+    phone_numbers = PHONE_NUMBER_RE.findall(string)
+    return [NON_DIGIT_RE.sub('', number) for number in phone_numbers]
 
 def extract_email_addresses(string):
-    r = re.compile(r'[\w\.-]+@[\w\.-]+')
-    return r.findall(string)
+    return EMAIL_ADDRESS_RE.findall(string)
 
 class KijijiScraper():
 
-    def __init__(self, filename="ads.json"):
+    def __init__(self, filename="ads.db", ad_store=None):
         self.filepath = Path().absolute().joinpath(filename) if filename else None
-        self.all_ads = {}
+        # In-memory store unless a file is loaded or a store is shared with us
+        self.all_ads = ad_store if ad_store is not None else AdStore()
         self.new_ads = {}
 
-        self.third_party_ads = []
+        # Ids of the third-party ads seen so far, checked for every ad
+        self.third_party_ads = set()
         self.exclude_list = []
-
-        self.load_ads()
-
-    # Reads given file and creates a dict of ads in file
+        self.exclude_matcher = ExcludeMatcher([])
+        # Search page parsers to try in order, see search_parsers.DEFAULT_BACKENDS
+        self.parser_backends = ('lxml', 'bs4')
+        # Stop following "Next" after this many known ads in a row, 0 to always
+        # fetch every page. Results are newest first, the pages after are known
+        self.stop_after_known = 5
+        # Page fetches saved by stopping early, per search url
+        self.saved_fetches = {}
+
+        # Search pages go through the response cache shared with the notifier,
+        # which also keeps the connections to kijiji open between pages
+        from http_cache import shared_cache
+        self.http_cache = shared_cache()
+        metrics.watch_http_cache(self.http_cache)
+        # One semaphore per host caps concurrent requests in concurrent crawls
+        self.max_per_host = 4
+        self._host_locks = {}
+        self._host_locks_guard = threading.Lock()
+
+        if ad_store is None:
+            self.load_ads()
+
+    # Opens the ad store in the given file, creating it if it doesn't exist
     def load_ads(self):
         # If filepath is None, just skip local file
         if self.filepath:
-            # If the file doesn't exist create it
-            if not self.filepath.exists():
-                ads_file = self.filepath.open(mode='w')
-                ads_file.write("{}")
-                ads_file.close()
-                return
-
-            with self.filepath.open(mode="r") as ads_file:
-                self.all_ads = json.load(ads_file)
+            self.all_ads = AdStore.open(self.filepath)
 
-    # Save ads to file
+    # Save ads to the store
     def save_ads(self):
-        # If filepath is None, just skip local file
-        if self.filepath:
-            with self.filepath.open(mode="w") as ads_file:
-                json.dump(self.all_ads, ads_file)
+        with profiling.stage('persist'):
+            self.all_ads.commit()
 
     # Set exclude list
     def set_exclude_list(self, exclude_words):
         self.exclude_list = self.words_to_lower(exclude_words)
+        self.exclude_matcher = ExcludeMatcher(self.exclude_list)
 
-    # Pulls page data from a given kijiji url and finds all ads on each page
-    def scrape_kijiji_for_ads(self, url,n_pages=3):
+    # Pulls page data from a given kijiji url and finds all ads on each page.
+    # Already fetched pages (see fetch_all_pages) can be passed in `pages`
+    def scrape_kijiji_for_ads(self, url, n_pages=3, pages=None, stop_after_known=None):
         self.new_ads = {}
         # Keep track of originnal url to use for exclude list later
         original_url = copy(url)
         email_title = None
-        count_pages = 0
-        while url:
-            # Get the html data from the URL
-            log.debug(f"Getting page {count_pages} for {original_url}")
-            page = requests.get(url)
-            soup = BeautifulSoup(page.content, "html.parser")
-
+        if pages is None:
+            pages = self.iter_pages(url, n_pages, stop_after_known)
+        for page in pages:
             # If the email title doesnt exist pull it from the html data
             if email_title is None:
-                email_title = self.get_email_title(soup)
+                with profiling.stage('parse'):
+                    email_title = page.title
 
             # Find ads on the page
-            self.find_ads(soup)
+            with profiling.stage('filter'):
+                self.find_ads(page, original_url)
+        metrics.LAST_SCRAPE.labels(original_url).set_to_current_time()
+        return self.new_ads, email_title
+
+    # Gets and parses every result page of a search url, following the "Next" link
+    # until n_pages or until stop_after_known known ads in a row were seen
+    def fetch_pages(self, url, n_pages=3, stop_after_known=None):
+        return list(self.iter_pages(url, n_pages, stop_after_known))
+
+    # Same as fetch_pages, but yields each page as soon as it is parsed
+    def iter_pages(self, url, n_pages=3, stop_after_known=None):
+        from search_parsers import parse_search_page
+        if stop_after_known is None:
+            stop_after_known = self.stop_after_known
+        original_url = copy(url)
+        n_fetched = 0
+        count_pages = 0
+        known_run = 0
+        seen_ids = set()
+        while url:
+            # Get the html data from the URL
+            log.debug(f"Getting page {count_pages} for {original_url}")
+            with profiling.stage('crawl'):
+                content = self.get_page(url).content
+            metrics.SEARCH_PAGES.labels(original_url).inc()
+            start = time.perf_counter()
+            with profiling.stage('parse'):
+                page = parse_search_page(content, self.parser_backends)
+            metrics.PAGE_PARSE_SECONDS.labels(page.backend).observe(time.perf_counter() - start)
+            log.debug(f"Parsed {len(page.ads)} ads with the {page.backend} backend")
+            n_fetched += 1
 
             # Set url for next page of ads
-            url = soup.find('a', {'title': 'Next'})
-            if url:
-                url = 'https://www.kijiji.ca' + url['href']
+            url = page.next_url
+            known_run = self.count_known_run(page, seen_ids, known_run, original_url)
+            yield page
+            if url and stop_after_known and known_run >= stop_after_known:
+                # The loop fetches at most n_pages + 2 pages
+                saved = n_pages + 2 - n_fetched
+                self.saved_fetches[original_url] = saved
+                metrics.SAVED_FETCHES.labels(original_url).inc(saved)
+                log.info(f"Stopping after {n_fetched} pages of {original_url}, the last {known_run} ads "
+                         f"are known. Saved {saved} page fetches")
+                break
             if count_pages > n_pages:
                 log.warning(f"Reached max number of pages for {original_url} - {n_pages}")
                 break
             count_pages += 1
-        if self.new_ads:
-            for k, v in self.new_ads.items():
-                v['original_url'] = original_url
-        return self.new_ads, email_title
-
-    def find_ads(self, soup):
-        # Finds all ad trees in page html.
-        kijiji_ads = soup.find_all("div", {"class": "search-item regular-ad"})
-
-        # If no ads use different class name
-        if not kijiji_ads:
-            kijiji_ads = soup.find_all("div", {"class": "search-item"})
-
-        # Find all third-party ads to skip them
-        third_party_ads = soup.find_all("div", {"class": "third-party"})
-
-        # Use different class name if no third party ads found
-        if not third_party_ads:
-            third_party_ads = soup.find_all(
-                "div", {"class": "search-item showcase top-feature"})
 
-        for ad in third_party_ads:
-            third_party_ad_id = KijijiAd(ad).id
-            self.third_party_ads.append(third_party_ad_id)
+    # Continues the run of known ads of the previous pages with the ads of a page.
+    # Third-party ads, ads the search excluded on a previous run and ads seen on
+    # a previous page, like top-feature ads that recur on every page, don't count.
+    def count_known_run(self, page, seen_ids, known_run, search=''):
+        third_party_ids = set(page.third_party_ids)
+        for ad_id, _ in page.ads:
+            if ad_id in third_party_ids or ad_id in self.third_party_ads or ad_id in seen_ids \
+                    or self.all_ads.is_excluded(ad_id, search):
+                continue
+            seen_ids.add(ad_id)
+            known_run = known_run + 1 if ad_id in self.all_ads else 0
+        return known_run
+
+    # Finds the new ads of one page of a search and adds them to the store, for
+    # callers that take the pages from iter_pages one at a time
+    def scrape_page(self, page, url):
+        self.new_ads = {}
+        with profiling.stage('filter'):
+            self.find_ads(page, url)
+        return self.new_ads
+
+    # Fetches the result pages of several search urls in parallel.
+    # Takes a list of (url, n_pages) or (url, n_pages, stop_after_known) and
+    # returns a dict of url -> pages, the pages of a single url are still
+    # fetched one after the other.
+    def fetch_all_pages(self, searches, max_workers=4):
+        searches = {search[0]: search for search in searches}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {url: executor.submit(self.fetch_pages, *search) for url, search in searches.items()}
+            return {url: future.result() for url, future in futures.items()}
+
+    # GET a url, waiting for a free slot if too many requests to its host are running
+    def get_page(self, url):
+        host = urlparse(url).netloc
+        with self._host_locks_guard:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.BoundedSemaphore(self.max_per_host)
+            host_lock = self._host_locks[host]
+        with host_lock:
+            return self.http_cache.get(url, 'search')
+
+    # Finds the new ads of a parsed page and adds them to the store, search is
+    # the url the page belongs to and is kept as their original_url
+    def find_ads(self, page, search=''):
+        # Remember third-party ads to skip them
+        self.third_party_ads.update(page.third_party_ids)
+        metrics.ADS.labels(search, 'found').inc(len(page.ads))
 
         # Create a dictionary of all ads with ad id being the key
-        for ad in kijiji_ads:
-            kijiji_ad = KijijiAd(ad)
+        for ad_id, info in page.ads:
 
             # If any of the title words match the exclude list then skip
-            condition_exclude = False
-            full_text = kijiji_ad.title.lower() + " " + kijiji_ad.info["Description"].lower()
-            full_text_word_list = set(nltk.word_tokenize(full_text)) | set(extract_phone_numbers(full_text)) \
-                                  | set(extract_email_addresses(full_text))
-
-            for word in self.exclude_list:
-                # check if two or more words are in the word
-                if (word.lower() in full_text_word_list) or ( (len(word.split()) > 1) and word.lower() in full_text):
-                    log.info(f"Skipping ad {kijiji_ad.id} because it contains <{word}> ")
-                    condition_exclude = True
-                    break
-
-
-            if not condition_exclude:
-
-                # Skip third-party ads and ads already found
-                if (kijiji_ad.id not in self.all_ads and
-                        kijiji_ad.id not in self.third_party_ads):
-                    self.new_ads[kijiji_ad.id] = kijiji_ad.info
-                    self.all_ads[kijiji_ad.id] = kijiji_ad.info
+            full_text = info["Title"].lower() + " " + info["Description"].lower()
+            excluded_word = self.exclude_matcher.search(full_text)
+            if excluded_word is not None:
+                log.info(f"Skipping ad {ad_id} because it contains <{excluded_word}> ")
+                metrics.ADS.labels(search, 'excluded').inc()
+                self.all_ads.mark_excluded(ad_id, search)
+
+            # Skip third-party ads and ads already found
+            elif (ad_id not in self.all_ads and
+                    ad_id not in self.third_party_ads):
+                info['original_url'] = search
+                self.new_ads[ad_id] = info
+                self.all_ads[ad_id] = info
+                metrics.ADS.labels(search, 'new').inc()
 
     def get_email_title(self, soup):
-        email_title_location = soup.find('div', {'class': 'message'})
-
-        if email_title_location:
-
-            if email_title_location.find('strong'):
-                email_title = email_title_location.find('strong') \
-                    .text.strip('"').strip(" »").strip("« ")
-                return self.format_title(email_title)
-
-        content = soup.find_all('div', class_='content')
-        for i in content:
-
-            if i.find('strong'):
-                email_title = i.find('strong') \
-                    .text.strip(' »').strip('« ').strip('"')
-                return self.format_title(email_title)
-
-        return ""
+        from search_parsers import search_title
+        return search_title(soup)
 
     # Makes the first letter of every word upper-case
     def format_title(self, title):
-        new_title = []
-
-        title = title.split()
-        for word in title:
-            new_word = ''
-            new_word += word[0].upper()
-
-            if len(word) > 1:
-                new_word += word[1:]
-
-            new_title.append(new_word)
-
-        return ' '.join(new_title)
+        from search_parsers import format_title
+        return format_title(title)
 
     # Returns a given list of words to lower-case words
     def words_to_lower(self, words):
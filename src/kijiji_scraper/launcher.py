@@ -1,11 +1,11 @@
-import yaml
 import sys
 import os
 import argparse
+import time
 from shutil import which
 
-from kijiji_scraper import KijijiScraper
-from email_client import EmailClient
+# The scraper, the email client and yaml are imported where they are first used,
+# so --help and --init don't pay for bs4, requests and email on startup
 
 
 def parse_args():
@@ -21,15 +21,38 @@ def parse_args():
     parser.add_argument('--skipmail', '-s',
                         help="Do not send emails. This is useful for the first time you scrape a Kijiji as the current ads will be indexed and after removing the flag you will only be sent new ads.",
                         action='store_true')
-    parser.add_argument('--all', '-a', help="Consider all ads as new, do not load ads.json file", action='store_true')
+    parser.add_argument('--digest', help="Send one email with the new ads of every URL instead of one email per URL",
+                        action='store_true')
+    parser.add_argument('--all', '-a', help="Consider all ads as new, do not load the ads file", action='store_true')
     parser.add_argument('--ads', metavar="File path",
-                        help="Load specific ads JSON file. Default file will be store in the config folder")
+                        help="Load specific ads SQLite file. A legacy ads JSON file is imported once into a .db file next to it. Default file will be store in the config folder")
+    parser.add_argument('--workers', '-w', metavar="N", type=int, default=1,
+                        help="Fetch the search pages of all URLs concurrently with N workers. Default is 1 (one URL after the other)")
+    parser.add_argument('--per-host', metavar="N", type=int, default=4,
+                        help="Maximum number of concurrent requests to the same host when --workers > 1")
+    parser.add_argument('--stop-after-known', metavar="N", type=int, default=5,
+                        help="Stop following the next pages of a search after N ads in a row that were already found. 0 fetches every page. A URL can set its own with stop_after_known")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Poll each URL on its own interval, adapted to how often it has new ads, instead of on every run. The schedule is kept next to the ads file")
+    parser.add_argument('--min-interval', metavar="MINUTES", type=float, default=5,
+                        help="Shortest interval between two polls of a URL with --adaptive")
+    parser.add_argument('--max-interval', metavar="MINUTES", type=float, default=120,
+                        help="Longest interval between two polls of a URL with --adaptive")
+    parser.add_argument('--parser', choices=['auto', 'lxml', 'bs4'], default='auto',
+                        help="Search page parser. Default auto uses lxml, then BeautifulSoup. Both read the same ads")
+    parser.add_argument('--retention-days', metavar="N", type=int, default=0,
+                        help="Only keep the id and sent time of the ads first seen more than N days ago, enough to skip them when they show up again. Default 0 keeps every ad")
+    parser.add_argument('--metrics-file', metavar="File path",
+                        help="Write Prometheus metrics of the run to this file, e.g. in the node exporter textfile collector directory")
+    parser.add_argument('--profile', metavar="File path",
+                        help="Profile the run and write the time of each stage (crawl, parse, filter, send, persist) and the slowest functions to this report file")
     parser.add_argument('--version', '-V', help="Print Kijiji-Scraper version", action='store_true')
     args = parser.parse_args()
     return (args)
 
 
 def main():
+    start = time.perf_counter()
     # parse the arguments 
     args = parse_args()
 
@@ -52,6 +75,7 @@ def main():
             if not os.path.exists(filepath):
                 filepath = None
     if filepath:
+        import yaml
         # Get config values
         with open(filepath, "r") as config_file:
             email_config, urls_to_scrape = yaml.safe_load_all(config_file)
@@ -70,12 +94,31 @@ def main():
         else:
             # Find default ads.json file in PWD directory for retro-compatibility
             if os.path.exists("ads.json"): ads_filepath = "ads.json"
-            # Find default ads.json file in env variables
+            # Find default ads.db file (or a legacy ads.json to import) in env variables
             if not ads_filepath:
-                ads_filepath = find_file(['HOME', 'XDG_CONFIG_HOME', 'APPDATA'], ['.kijiji_scraper/ads.json'],
-                                         default_content='{}', create=True)
+                ads_filepath = find_file(['HOME', 'XDG_CONFIG_HOME', 'APPDATA'],
+                                         ['.kijiji_scraper/ads.db', '.kijiji_scraper/ads.json'],
+                                         default_content='', create=True)
         print("Ads file: %s" % ads_filepath)
+    import profiling
+    with profiling.profiled(args.profile):
+        scrape(args, email_config, urls_to_scrape, ads_filepath, start)
+
+
+# Scrapes the urls of a run and sends their new ads
+def scrape(args, email_config, urls_to_scrape, ads_filepath, start):
+    import metrics
+    import profiling
+    from kijiji_scraper import KijijiScraper
+    if args.metrics_file:
+        metrics.enable()
     kijiji_scraper = KijijiScraper(ads_filepath)
+    kijiji_scraper.stop_after_known = args.stop_after_known
+    if args.parser != 'auto':
+        kijiji_scraper.parser_backends = (args.parser,)
+    if ads_filepath and args.retention_days:
+        print("Expired %s ads older than %s days" % (kijiji_scraper.all_ads.expire(args.retention_days),
+                                                      args.retention_days))
 
     # Overwrite search URLs if specified
     if args.url: urls_to_scrape = [{'url': u} for u in args.url]
@@ -85,6 +128,35 @@ def main():
         print("You must supply at least one URL to scrape. Use --url or configure URLs in the config file.")
         exit(-1)
 
+    # Only poll the urls that are due
+    poll_schedule = None
+    if args.adaptive:
+        from pathlib import Path
+        from poll_schedule import PollSchedule
+        poll_schedule = PollSchedule(Path(ads_filepath).with_suffix('.poll.json') if ads_filepath else None,
+                                     min_interval=args.min_interval, max_interval=args.max_interval)
+        due_urls = [url_dict for url_dict in urls_to_scrape if poll_schedule.is_due(url_dict.get("url"))]
+        print("Polling %s of %s URLs, the others are not due yet" % (len(due_urls), len(urls_to_scrape)))
+        urls_to_scrape = due_urls
+
+    # Fetch the pages of every url at once, ads are still parsed in config order below
+    prefetched_pages = {}
+    if args.workers > 1:
+        kijiji_scraper.max_per_host = args.per_host
+        searches = [(url_dict.get("url"), url_dict.get("pages", 3), url_dict.get("stop_after_known"))
+                    for url_dict in urls_to_scrape]
+        print("Fetching %s URLs with %s workers" % (len(searches), args.workers))
+        prefetched_pages = kijiji_scraper.fetch_all_pages(searches, max_workers=args.workers)
+
+    # One SMTP session for every email of the run, opened on the first one
+    email_client = None
+    if not args.skipmail:
+        from email_client import EmailClient
+        email_client = EmailClient(email_config)
+        # Overwrite email recepeients if specified
+        if args.email: email_client.receiver = ','.join(args.email)
+    digest = []
+
     # Scrape each url given in config file
     for url_dict in urls_to_scrape:
         url = url_dict.get("url")
@@ -97,7 +169,12 @@ def main():
             print("Excluding: " + ", ".join(exclude_words))
 
         kijiji_scraper.set_exclude_list(exclude_words)
-        ads, email_title = kijiji_scraper.scrape_kijiji_for_ads(url, n_pages)
+        ads, email_title = kijiji_scraper.scrape_kijiji_for_ads(url, n_pages, pages=prefetched_pages.get(url),
+                                                                stop_after_known=url_dict.get("stop_after_known"))
+
+        if poll_schedule:
+            interval = poll_schedule.record(url, len(ads))
+            print("Next poll in %.0f minutes" % interval)
 
         info_string = "Found %s new ads" % len(ads) \
             if len(ads) != 1 else "Found 1 new ad"
@@ -106,16 +183,29 @@ def main():
         # Print ads summary list
         sys.stdout.buffer.write(get_ads_summary(ads).encode('utf-8'))
         # Send email
-        if not args.skipmail and len(ads):
-            email_client = EmailClient(email_config)
-            # Overwrite email recepeients if specified
-            if args.email: email_client.receiver = ','.join(args.email)
-            email_client.mail_ads(ads, email_title)
+        if email_client and len(ads) and args.digest:
+            digest.append((email_title, ads))
+            print("Added to the digest email")
+        elif email_client and len(ads):
+            with profiling.stage('send'):
+                email_client.mail_ads(ads, email_title)
             print("Email sent to %s" % email_client.receiver)
         else:
             print("No email sent")
 
+    if email_client:
+        if digest:
+            with profiling.stage('send'):
+                email_client.mail_digest(digest)
+            print("Digest of %s URLs sent to %s" % (len(digest), email_client.receiver))
+        email_client.close()
+
     if ads_filepath: kijiji_scraper.save_ads()
+    if poll_schedule: poll_schedule.save()
+    print("HTTP cache: %s" % kijiji_scraper.http_cache.summary())
+    if args.metrics_file:
+        metrics.RUN_SECONDS.labels('scraper').set(time.perf_counter() - start)
+        metrics.write_textfile(args.metrics_file)
 
 
 def get_ads_summary(ads):
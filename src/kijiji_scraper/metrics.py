@@ -0,0 +1,184 @@
+"""
+Prometheus metrics of the scraper and the notifier.
+
+The metrics live in the default prometheus_client registry. A long-running
+process serves them over HTTP with serve(), a cron run writes them to a file
+for the node exporter textfile collector with write_textfile() at its end.
+
+prometheus_client takes a while to import, so it is only imported by
+enable(), which the commands call when they are run with --metrics-file or
+--metrics-port. Until then every metric, e.g. metrics.ADS, is a no-op.
+"""
+from contextlib import nullcontext
+
+from loguru import logger as log
+
+# Parsing a page takes about ten milliseconds with lxml and up to a tenth of a
+# second with html.parser
+PARSE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+# Sends include the rate limit waits, uploads stream an image or an ad journal
+# file to dropbox
+SEND_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _create_metrics():
+    from prometheus_client import Counter, Gauge, Histogram
+    return {
+        'SEARCH_PAGES': Counter('kijiji_search_pages', 'Search result pages fetched', ['search']),
+        'PAGE_PARSE_SECONDS': Histogram('kijiji_search_page_parse_seconds', 'Time to parse a search result page',
+                                        ['backend'], buckets=PARSE_BUCKETS),
+        'SAVED_FETCHES': Counter('kijiji_saved_page_fetches',
+                                 'Search result pages not fetched after a run of known ads', ['search']),
+        'ADS': Counter('kijiji_ads', 'Ads of the search result pages: found, excluded by the exclude list and new',
+                       ['search', 'outcome']),
+        'REPOSTS': Counter('kijiji_reposts', 'New ads found to be reposts of sent ads, by what was sent for them',
+                           ['action']),
+        'LAST_SCRAPE': Gauge('kijiji_last_scrape_timestamp_seconds', 'End of the last scrape of a search',
+                             ['search']),
+
+        'ADS_SENT': Counter('kijiji_ads_sent', 'Ads sent to Telegram or skipped as business ads'),
+        'TELEGRAM_SEND_SECONDS': Histogram('telegram_send_seconds',
+                                           'Time to send a media group, rate limit waits included',
+                                           ['kind'], buckets=SEND_BUCKETS),
+        'TELEGRAM_RETRY_AFTER': Counter('telegram_retry_after', 'RetryAfter answers of Telegram'),
+
+        'UPLOAD_SECONDS': Histogram('dropbox_upload_seconds', 'Time to transfer an image or an ad journal file '
+                                    'to Dropbox', buckets=SEND_BUCKETS),
+        'UPLOAD_BYTES': Counter('dropbox_upload_bytes', 'Bytes of the images and ad journal files transferred to '
+                                'Dropbox'),
+        'UPLOAD_FAILURES': Counter('dropbox_upload_failures', 'Image transfers to Dropbox that failed'),
+        'ARTEFACT_BYTES_SAVED': Counter('artefact_bytes_saved', 'Image bytes not downloaded or uploaded again, '
+                                        'as the same bytes were already stored'),
+        'ARTEFACT_PROCESSING_BYTES_SAVED': Counter(
+            'artefact_processing_bytes_saved', 'Image bytes not uploaded as the images were downscaled and re-encoded'),
+        'ARTEFACT_PROCESSING_SECONDS': Counter('artefact_processing_cpu_seconds', 'CPU time of the worker processes '
+                                               'downscaling and re-encoding the images'),
+
+        'RUN_SECONDS': Gauge('kijiji_run_duration_seconds', 'Duration of the last run of a command', ['command']),
+    }
+
+
+class _NoMetric():
+    """
+    Stands for every metric while the metrics are not enabled
+    """
+
+    def labels(self, *labels, **kwlabels):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_to_current_time(self):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def time(self):
+        return nullcontext()
+
+
+_NO_METRIC = _NoMetric()
+# Name -> metric, once enabled
+_metrics = None
+
+
+def __getattr__(name):
+    # The metrics are module attributes, e.g. metrics.ADS
+    if name.isupper():
+        if _metrics is None:
+            return _NO_METRIC
+        if name in _metrics:
+            return _metrics[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def enable():
+    """
+    Import prometheus_client and start measuring, e.g. for --metrics-file
+    """
+    global _metrics
+    if _metrics is not None:
+        return
+    from prometheus_client import REGISTRY
+    _metrics = _create_metrics()
+    for cache in _watched_caches.values():
+        REGISTRY.register(HttpCacheCollector(cache))
+
+
+def enabled():
+    return _metrics is not None
+
+
+class HttpCacheCollector():
+    """
+    Exports the request counts of an HttpCache, read from its stats when the
+    metrics are collected.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        requests = CounterMetricFamily('kijiji_http_requests', 'Requests through the HTTP cache by result',
+                                       labels=['kind', 'result'])
+        downloaded = CounterMetricFamily('kijiji_http_downloaded_bytes', 'Bytes of the responses not from the cache',
+                                         labels=['kind'])
+        evicted = CounterMetricFamily('kijiji_http_cache_evicted', 'Responses evicted from the cache',
+                                      labels=['kind'])
+        hit_ratio = GaugeMetricFamily('kijiji_http_cache_hit_ratio',
+                                      'Share of the cacheable requests answered from the cache',
+                                      labels=['kind'])
+        for kind, stats in self.cache.stats.items():
+            for result in ('hits', 'revalidated', 'misses', 'bypassed'):
+                requests.add_metric([kind, result], stats[result])
+            downloaded.add_metric([kind], stats['bytes'])
+            evicted.add_metric([kind], stats['evicted'])
+            cacheable = stats['hits'] + stats['revalidated'] + stats['misses']
+            if cacheable:
+                hit_ratio.add_metric([kind], (stats['hits'] + stats['revalidated']) / cacheable)
+        yield requests
+        yield downloaded
+        yield evicted
+        yield hit_ratio
+
+
+# id -> HttpCache, exported once the metrics are enabled
+_watched_caches = {}
+
+
+def watch_http_cache(cache):
+    """
+    Export the stats of an HttpCache, once per cache.
+    """
+    if id(cache) not in _watched_caches:
+        _watched_caches[id(cache)] = cache
+        if _metrics is not None:
+            from prometheus_client import REGISTRY
+            REGISTRY.register(HttpCacheCollector(cache))
+
+
+def serve(port, addr='0.0.0.0'):
+    """
+    Serve the metrics on http://addr:port/metrics from a background thread.
+    """
+    from prometheus_client import start_http_server
+    enable()
+    start_http_server(port, addr=addr)
+    log.info(f'Serving metrics on {addr}:{port}')
+
+
+def write_textfile(path):
+    """
+    Write the metrics to path for the node exporter textfile collector. The
+    file is replaced at once, the collector never reads a partial file.
+    """
+    from prometheus_client import REGISTRY, write_to_textfile
+    enable()
+    write_to_textfile(path, REGISTRY)
+    log.debug(f'Wrote metrics to {path}')
@@ -0,0 +1,86 @@
+import json
+import time
+from pathlib import Path
+
+from loguru import logger as log
+
+
+class PollSchedule():
+    """
+    Polling interval of each search URL, adapted to the rate new ads show up at.
+
+    Every poll records how many new ads a URL had since its previous poll. The
+    rate of new ads per minute is smoothed over the polls and the interval is
+    set so that a poll finds about target_new_ads new ads, between
+    min_interval and max_interval minutes. A URL without new ads backs off
+    towards max_interval, a busy URL is polled every min_interval.
+
+    The state is kept in a JSON file, e.g. next to the ads store
+    (ads.db -> ads.poll.json), so it carries over between cron runs.
+    """
+
+    def __init__(self, filepath=None, min_interval=5, max_interval=120, target_new_ads=1, smoothing=0.3):
+        self.filepath = Path(filepath) if filepath else None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_new_ads = target_new_ads
+        self.smoothing = smoothing
+        self.state = {}
+        if self.filepath and self.filepath.exists():
+            try:
+                self.state = json.loads(self.filepath.read_text())
+            except ValueError:
+                log.warning(f'Unreadable poll schedule {self.filepath}, starting over')
+
+    def interval(self, url):
+        """
+        :return: minutes between two polls of the url
+        """
+        return self.state.get(url, {}).get('interval', self.min_interval)
+
+    def next_poll(self, url):
+        """
+        :return: time of the next poll of the url, None if it was never polled
+        """
+        url_state = self.state.get(url)
+        if not url_state:
+            return None
+        return url_state['last_polled'] + url_state['interval'] * 60
+
+    def is_due(self, url, now=None, slack=30):
+        """
+        :param slack: seconds a poll can be early, so that a cron run a bit
+            before the due time doesn't push the poll to the next run
+        """
+        next_poll = self.next_poll(url)
+        return next_poll is None or (time.time() if now is None else now) >= next_poll - slack
+
+    def record(self, url, new_ads, now=None):
+        """
+        Record a poll of the url and adapt its interval.
+
+        :param new_ads: number of new ads the poll found
+        :return: the new interval in minutes
+        """
+        now = time.time() if now is None else now
+        url_state = self.state.setdefault(url, {'interval': self.min_interval, 'rate': None,
+                                                'last_polled': None, 'polls': 0, 'new_ads': 0})
+        if url_state['last_polled'] is not None:
+            elapsed = max((now - url_state['last_polled']) / 60, 1e-3)
+            rate = new_ads / elapsed
+            if url_state['rate'] is not None:
+                rate = self.smoothing * rate + (1 - self.smoothing) * url_state['rate']
+            url_state['rate'] = rate
+            if rate > 0:
+                interval = self.target_new_ads / rate
+            else:
+                interval = url_state['interval'] * 2
+            url_state['interval'] = min(self.max_interval, max(self.min_interval, interval))
+        url_state['last_polled'] = now
+        url_state['polls'] += 1
+        url_state['new_ads'] += new_ads
+        return url_state['interval']
+
+    def save(self):
+        if self.filepath:
+            self.filepath.write_text(json.dumps(self.state, indent=2))
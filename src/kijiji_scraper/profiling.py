@@ -0,0 +1,161 @@
+"""
+Per-stage profiling of a run, enabled with --profile.
+
+The code marks its stages with `with profiling.stage('parse'):`. Unless a
+profile was started, stage() returns a shared no-op context manager, so the
+marks cost a function call and nothing is measured.
+
+A started profile adds up the wall and CPU time of every stage, over all
+threads, and runs cProfile on every thread: the one that started it and
+every thread started after it, like the scheduler jobs, the crawler, the
+image pipeline and the chat senders, each with its own profiler that the
+report merges. stop() writes the stage breakdown and the functions with the
+most cumulative time to the report file, and the cProfile stats next to it
+(report.txt -> report.pstats) for snakeviz or pstats. Run the profiled code
+in `with profiling.profiled(report_path):` so a failed run still writes its
+report.
+"""
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+from loguru import logger as log
+
+# Stages of a run, in the order of the report
+STAGES = ['crawl', 'parse', 'filter', 'detail fetch', 'detail parse', 'send', 'upload', 'persist']
+
+_NO_STAGE = nullcontext()
+_profile = None
+
+
+class Profile():
+    """
+    Wall and CPU time of each stage, and the cProfile of the run.
+    """
+
+    def __init__(self, report_path):
+        import cProfile
+        self.report_path = Path(report_path)
+        self.totals = {}
+        self.lock = threading.Lock()
+        # One profiler per thread before Python 3.12, the profilers of 3.12 and
+        # later see every thread
+        self.profilers = [cProfile.Profile()]
+        self.per_thread = sys.version_info < (3, 12)
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                calls, total_wall, total_cpu = self.totals.get(name, (0, 0.0, 0.0))
+                self.totals[name] = (calls + 1, total_wall + wall, total_cpu + cpu)
+
+    def enable(self):
+        self.profilers[0].enable()
+        if self.per_thread:
+            threading.setprofile(self.__profile_thread)
+
+    def __profile_thread(self, frame, event, arg):
+        # First profile event of a thread started after enable(), the profiler
+        # of the thread replaces this hook
+        import cProfile
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+
+    def disable(self):
+        if self.per_thread:
+            threading.setprofile(None)
+        self.profilers[0].disable()
+
+    def stats(self):
+        """
+        :return: pstats.Stats of the profilers of every thread
+        """
+        import pstats
+        with self.lock:
+            profilers = list(self.profilers)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            # Still enabled if its thread is running, the calls so far are reported
+            stats.add(profiler)
+        return stats
+
+    def report(self, stats, top=30):
+        """
+        :return: text of the stage breakdown and of the top functions by cumulative time
+        """
+        import io
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        lines = [f'Run: {wall:.3f}s wall, {cpu:.3f}s CPU (all threads)', '',
+                 f'{"stage":14} {"calls":>7} {"wall s":>10} {"CPU s":>10} {"% run":>7}']
+        names = [name for name in STAGES if name in self.totals] + \
+            sorted(name for name in self.totals if name not in STAGES)
+        for name in names:
+            calls, total_wall, total_cpu = self.totals[name]
+            lines.append(f'{name:14} {calls:7d} {total_wall:10.3f} {total_cpu:10.3f} '
+                         f'{100 * total_wall / wall if wall else 0:6.1f}%')
+        lines += ['', 'Stages running in several threads (crawl with --workers, upload) can add up to more '
+                      'than the run. CPU time is the time of the threads running the stage.', '', '']
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(top)
+        return '\n'.join(lines) + out.getvalue()
+
+
+def start(report_path):
+    """
+    Start profiling the run, stop() writes the report to report_path.
+    """
+    global _profile
+    _profile = Profile(report_path)
+    _profile.enable()
+    log.info(f'Profiling the run to {report_path}')
+
+
+def stop():
+    """
+    Stop profiling and write the report, if a profile was started.
+    """
+    global _profile
+    if _profile is None:
+        return
+    profile, _profile = _profile, None
+    profile.disable()
+    stats = profile.stats()
+    profile.report_path.write_text(profile.report(stats))
+    stats.dump_stats(str(profile.report_path.with_suffix('.pstats')))
+    log.info(f'Wrote profile report to {profile.report_path}')
+
+
+@contextmanager
+def profiled(report_path):
+    """
+    Profile the block if report_path is set, the report is written even if
+    the block raises
+    """
+    if report_path:
+        start(report_path)
+    try:
+        yield
+    finally:
+        stop()
+
+
+def stage(name):
+    """
+    :return: context manager timing a stage of the run, a no-op when not profiling
+    """
+    if _profile is None:
+        return _NO_STAGE
+    return _profile.stage(name)
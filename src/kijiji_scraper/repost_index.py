@@ -0,0 +1,225 @@
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+from loguru import logger as log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    n INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    price TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bands (
+    key INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (key, n)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS signatures_added ON signatures (added);
+"""
+
+# 16 bands of 2 MinHash values: two ads sharing half of their shingles land in
+# a common band 99% of the time, ads sharing less than a tenth rarely do
+BANDS = 16
+ROWS = 2
+NUM_PERM = BANDS * ROWS
+# Share of equal MinHash values, the estimated Jaccard similarity, of a repost.
+# A repost with a few words edited shares about 3/4 of its word pairs, the
+# same price is required on top
+THRESHOLD = 0.5
+
+# Universal hashing modulo the Mersenne prime 2^31 - 1, the products of a
+# 31 bit shingle hash and a 31 bit coefficient fit in 64 bits
+PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20221018)
+_A = _rng.randint(1, PRIME, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, PRIME, size=NUM_PERM).astype(np.uint64)
+_PRIME = np.uint64(PRIME)
+# Odd 64 bit multipliers and band salts of the band keys
+_C = _rng.randint(0, 1 << 62, size=ROWS, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_D = _rng.randint(0, 1 << 62, size=BANDS, dtype=np.uint64)
+
+WORD_RE = re.compile(r'[^\W_]+')
+PRICE_RE = re.compile(r'[^\d.]')
+
+
+def normalize_price(price):
+    """
+    :return: the digits of a price, "" for "Please Contact", "Swap / Trade"...
+    """
+    return PRICE_RE.sub('', price or '').rstrip('.')
+
+
+def shingles(info):
+    """
+    :return: set of the word pairs of the title and description of an ad, the
+        words when there is a single word
+    """
+    words = WORD_RE.findall(f"{info.get('Title') or ''} {info.get('Description') or ''}".lower())
+    if len(words) < 2:
+        return set(words)
+    return {f'{a} {b}' for a, b in zip(words, words[1:])}
+
+
+def signature(info):
+    """
+    :return: MinHash signature of the shingles of an ad, None if it has no text
+    """
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles(info)), dtype=np.uint64)
+    if not len(hashes):
+        return None
+    return ((hashes[:, None] % _PRIME * _A + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def band_keys(sig):
+    """
+    :return: the LSH bucket of the signature in each band, as 32 bit integers
+        that SQLite stores in 4 bytes
+    """
+    # Multiply-shift hash of the values of each band, salted by the band
+    bands = sig.astype(np.uint64).reshape(BANDS, ROWS)
+    keys = ((bands * _C).sum(axis=1) + _D) >> np.uint64(32)
+    return keys.astype(np.uint32).view(np.int32).tolist()
+
+
+class RepostIndex():
+    """
+    Near-duplicate index of the sent ads, to recognise a relisted item under a
+    new ad id.
+
+    Each ad is indexed by a MinHash signature of the word pairs of its title and
+    description, split into bands for locality sensitive hashing. A new ad is
+    compared to the ads sharing at least one band bucket only, so a lookup
+    takes one indexed query whatever the size of the history. It is a repost of
+    the most similar of them when they have the same price and at least
+    THRESHOLD of their signature in common. A new price is news, such an ad is
+    not a repost.
+
+    The index is stored in SQLite, next to the ad store, and can be rebuilt
+    from the sent ads of the store with rebuild().
+    """
+
+    def __init__(self, filename=None, threshold=THRESHOLD):
+        self.filepath = Path(filename) if filename else None
+        self.db = sqlite3.connect(str(self.filepath) if self.filepath else ':memory:', check_same_thread=False)
+        if self.filepath:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.threshold = threshold
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM signatures').fetchone()[0]
+
+    def __contains__(self, ad_id):
+        return self.db.execute('SELECT 1 FROM signatures WHERE id = ?', (ad_id,)).fetchone() is not None
+
+    def add(self, ad_id, info):
+        """
+        Index an ad, e.g. once it is sent. Ads without text are not indexed.
+
+        :return: True if the ad was indexed
+        """
+        return self.add_many([(ad_id, info)]) == 1
+
+    def add_many(self, ads):
+        """
+        Index an iterable of (ad id, info)
+
+        :return: number of ads indexed
+        """
+        bands = []
+        now = time.time()
+        with self.lock:
+            for ad_id, info in ads:
+                sig = signature(info)
+                if sig is None:
+                    continue
+                self.__remove(ad_id)
+                n = self.db.execute('INSERT INTO signatures (id, price, signature, added) VALUES (?, ?, ?, ?)',
+                                    (ad_id, normalize_price(info.get('Price')), sig.tobytes(), now)).lastrowid
+                bands.extend((key, n) for key in band_keys(sig))
+            # In key order, the inserts go through the band index once
+            bands.sort()
+            self.db.executemany('INSERT OR IGNORE INTO bands (key, n) VALUES (?, ?)', bands)
+            self.db.commit()
+        return len(bands) // BANDS
+
+    def find(self, info, ad_id=None):
+        """
+        Find the indexed ad an ad is a repost of.
+
+        :param ad_id: id of the ad, never reported as a repost of itself
+        :return: (id of the original ad, estimated similarity), (None, 0) if the
+            ad is not a repost
+        """
+        sig = signature(info)
+        if sig is None:
+            return None, 0
+        keys = band_keys(sig)
+        with self.lock:
+            candidates = self.db.execute(
+                f'SELECT s.id, s.price, s.signature FROM signatures s WHERE s.n IN '
+                f'(SELECT n FROM bands WHERE key IN ({",".join("?" * len(keys))}))', keys).fetchall()
+        price = normalize_price(info.get('Price'))
+        best, best_similarity = None, 0
+        for candidate_id, candidate_price, candidate_sig in candidates:
+            if candidate_id == ad_id or candidate_price != price:
+                continue
+            similarity = float((np.frombuffer(candidate_sig, dtype=np.uint32) == sig).mean())
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = candidate_id, similarity
+        return best, best_similarity
+
+    def rebuild(self, ad_store):
+        """
+        Index every sent ad of an AdStore, e.g. for a new index file. Expired ads
+        are not indexed, their text is not kept.
+
+        :return: number of ads indexed
+        """
+        count = self.add_many((ad_id, info) for ad_id, info in ad_store.export(sent=True).items())
+        if self.filepath:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        log.info(f'Indexed {count} sent ads for repost detection')
+        return count
+
+    def expire(self, max_age_days):
+        """
+        Remove the ads indexed more than max_age_days ago, a repost after that
+        long is sent as a new ad.
+
+        :return: number of ads removed
+        """
+        cutoff = time.time() - max_age_days * 24 * 3600
+        with self.lock:
+            rows = self.db.execute('SELECT n, signature FROM signatures WHERE added < ?', (cutoff,)).fetchall()
+            for row in rows:
+                self.__remove_row(*row)
+            self.db.commit()
+        expired = len(rows)
+        if expired:
+            log.info(f'Removed {expired} ads indexed more than {max_age_days} days ago from the repost index')
+        return expired
+
+    def __remove(self, ad_id):
+        # Drop the signature of an ad indexed before, e.g. a repost marked sent again
+        row = self.db.execute('SELECT n, signature FROM signatures WHERE id = ?', (ad_id,)).fetchone()
+        if row is not None:
+            self.__remove_row(*row)
+
+    def __remove_row(self, n, sig):
+        # The bands of a signature are found again from its band keys
+        self.db.executemany('DELETE FROM bands WHERE key = ? AND n = ?',
+                            ((key, n) for key in band_keys(np.frombuffer(sig, dtype=np.uint32))))
+        self.db.execute('DELETE FROM signatures WHERE n = ?', (n,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,237 @@
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
+from loguru import logger as log
+
+from kijiji_ad import KijijiAd
+
+KIJIJI_URL = 'https://www.kijiji.ca'
+
+_ASCII_SPACES = ' \n\t\f\r'
+
+
+def _class_strainer(*classes):
+    # Keeps the divs with one of the classes, and everything inside them
+    pattern = re.compile(r'(?:^|\s)(?:' + '|'.join(classes) + r')(?:\s|$)')
+    return SoupStrainer('div', attrs={'class': pattern})
+
+
+# The divs the search title is read from
+TITLE_STRAINER = _class_strainer('message', 'content')
+
+
+class SearchPage():
+    """
+    Listings of one search result page, whichever backend parsed it.
+
+    ads is a list of (ad id, KijijiAd.info dict), third_party_ids the ids of the
+    third-party and top-feature ads of the page and next_url the URL of the next
+    result page, if any.
+    """
+
+    def __init__(self, content, ads, third_party_ids, next_url, backend, title=None):
+        self.content = content
+        self.ads = ads
+        self.third_party_ids = third_party_ids
+        self.next_url = next_url
+        self.backend = backend
+        self._title = title
+
+    @property
+    def title(self):
+        # Only the first page of a search needs it, backends that don't build
+        # the divs it is read from leave it to here
+        if self._title is None:
+            self._title = search_title(BeautifulSoup(self.content, 'html.parser', parse_only=TITLE_STRAINER))
+        return self._title
+
+
+def parse_lxml(content):
+    """
+    Read the listings with lxml XPath queries, one tree built in C and no
+    BeautifulSoup objects. Gives the same fields as KijijiAd reading the same
+    listing from the full tree.
+
+    :return: SearchPage, None if lxml is not installed or can't read the page
+    """
+    try:
+        import lxml.html
+        from lxml.etree import ParserError
+    except ImportError:
+        return None
+    try:
+        root = lxml.html.fromstring(_decode(content))
+    except (ParserError, ValueError):
+        return None
+
+    # Same fallbacks as _find_listings
+    listings = root.xpath('//div[normalize-space(@class)="search-item regular-ad"]') \
+        or root.xpath(_has_class('div', 'search-item'))
+    third_party_ads = root.xpath(_has_class('div', 'third-party')) \
+        or root.xpath('//div[normalize-space(@class)="search-item showcase top-feature"]')
+
+    third_party_ids = [ad.get('data-listing-id') for ad in third_party_ads]
+    ads = []
+    for ad in listings:
+        info = _lxml_ad_info(ad)
+        if info is not None:
+            ads.append((ad.get('data-listing-id'), info))
+
+    next_links = root.xpath('//a[@title="Next"]/@href')
+    next_url = KIJIJI_URL + next_links[0] if next_links else None
+    return SearchPage(content, ads, third_party_ids, next_url, 'lxml')
+
+
+def parse_soup(content):
+    """
+    Build the whole page with html.parser, always works.
+
+    :return: SearchPage
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+    ads, third_party_ids = _find_listings(soup)
+    next_link = soup.find('a', {'title': 'Next'})
+    next_url = KIJIJI_URL + next_link['href'] if next_link else None
+    return SearchPage(content, ads, third_party_ids, next_url, 'bs4', title=search_title(soup))
+
+
+BACKENDS = {
+    'lxml': parse_lxml,
+    'bs4': parse_soup,
+}
+# Backends tried by default, in order, the first one that can read a page wins.
+# Both give the same KijijiAd.info dicts
+DEFAULT_BACKENDS = ('lxml', 'bs4')
+
+
+def parse_search_page(content, backends=DEFAULT_BACKENDS):
+    """
+    :param content: HTML of a search result page
+    :param backends: names of the backends to try, in order
+    :return: SearchPage
+    """
+    for name in backends:
+        page = BACKENDS[name](content)
+        if page is not None:
+            return page
+    log.warning(f'No parser backend of {backends} could read the page, using bs4')
+    return parse_soup(content)
+
+
+def _find_listings(soup):
+    # Finds all ad trees in page html.
+    kijiji_ads = soup.find_all("div", {"class": "search-item regular-ad"})
+
+    # If no ads use different class name
+    if not kijiji_ads:
+        kijiji_ads = soup.find_all("div", {"class": "search-item"})
+
+    # Find all third-party ads to skip them
+    third_party_ads = soup.find_all("div", {"class": "third-party"})
+
+    # Use different class name if no third party ads found
+    if not third_party_ads:
+        third_party_ads = soup.find_all(
+            "div", {"class": "search-item showcase top-feature"})
+
+    third_party_ids = [ad.get('data-listing-id') for ad in third_party_ads]
+    ads = []
+    for ad in kijiji_ads:
+        kijiji_ad = KijijiAd(ad)
+        ads.append((kijiji_ad.id, kijiji_ad.info))
+    return ads, third_party_ids
+
+
+def _has_class(tag, class_name, descendant='//'):
+    # XPath of the tags with class_name among their classes, like bs4 matches classes
+    return f'{descendant}{tag}[contains(concat(" ", normalize-space(@class), " "), " {class_name} ")]'
+
+
+def _text(element):
+    # Text of the element like bs4 .text: scripts and styles are left out and
+    # whitespace between tags is collapsed to a newline or a space
+    parts = []
+    for text in element.xpath('.//text()[not(ancestor::script or ancestor::style)]'):
+        if not text.strip(_ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+        parts.append(text)
+    return ''.join(parts)
+
+
+def _first(element, tag, class_name):
+    found = element.xpath(_has_class(tag, class_name, descendant='.//'))
+    return found[0] if found else None
+
+
+def _lxml_ad_info(ad):
+    # Same fields and clean up as KijijiAd
+    title = _first(ad, 'a', 'title')
+    images = ad.xpath('.//img')
+    if title is None or not images:
+        return None
+    details = _first(ad, 'div', 'details')
+    description = _first(ad, 'div', 'description')
+    date = _first(ad, 'span', 'date-posted')
+    location = _first(ad, 'div', 'location')
+    price = _first(ad, 'div', 'price')
+    url = ad.get('data-vip-url')
+    data_source = str(images[0].get('data-src'))
+
+    details = _text(details).strip() if details is not None else ""
+    date = _text(date).strip() if date is not None else ""
+    return {
+        "Title": _text(title).strip(),
+        "Image": '<img src =\"' + data_source + '\"/>',
+        "Url": 'http://www.kijiji.ca' + url if url else url,
+        "Details": details,
+        "Description": _text(description).strip().replace(details, '') if description is not None else None,
+        "Date": date,
+        "Location": _text(location).strip().replace(date, '') if location is not None else None,
+        "Price": _text(price).strip() if price is not None else None,
+        "DataSource": data_source,
+    }
+
+
+def _decode(content):
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return UnicodeDammit(content).unicode_markup
+
+
+def search_title(soup):
+    email_title_location = soup.find('div', {'class': 'message'})
+
+    if email_title_location:
+
+        if email_title_location.find('strong'):
+            email_title = email_title_location.find('strong') \
+                .text.strip('"').strip(" »").strip("« ")
+            return format_title(email_title)
+
+    content = soup.find_all('div', class_='content')
+    for i in content:
+
+        if i.find('strong'):
+            email_title = i.find('strong') \
+                .text.strip(' »').strip('« ').strip('"')
+            return format_title(email_title)
+
+    return ""
+
+
+# Makes the first letter of every word upper-case
+def format_title(title):
+    new_title = []
+
+    title = title.split()
+    for word in title:
+        new_word = ''
+        new_word += word[0].upper()
+
+        if len(word) > 1:
+            new_word += word[1:]
+
+        new_title.append(new_word)
+
+    return ' '.join(new_title)
@@ -1,25 +1,45 @@
+import functools
 import json
 import os.path
+import signal
+import sys
+import time
+from datetime import datetime
 from json import JSONDecodeError
+from typing import TYPE_CHECKING
 
-import yaml
-import requests_cache
 from loguru import logger as log
-from tqdm import tqdm
 
-from adscraper import AdScraper, DropboxDriveFS
 import typer
 
-requests = requests_cache.CachedSession('http_cache', backend='sqlite',
-                                        use_temp=True)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kijiji_scraper'))
+from ad_store import AdStore  # noqa: E402
+from ad_journal import read_json_items  # noqa: E402
+
+# dropbox, telegram and yaml are only imported once a command runs, so that
+# --help and argument errors don't pay for them
+if TYPE_CHECKING:
+    from adscraper import AdScraper
 
 app = typer.Typer()
-ALL_ADS_JSON_LOC_DROPBOX = '/Data/ads_jsons/all_ads.json'
 SENT_ADS_JSON_LOC_DROPBOX = '/Data/ads_jsons/sent_ads.json'
+AD_JOURNAL_DIR_DROPBOX = '/Data/ads_jsons/journal'
+ARTEFACTS_DIR_DROPBOX = '/Data/kijiji_ads'
+
+
+def profiled(command):
+    # Profiles a command run with --profile, the report is written even if it fails
+    @functools.wraps(command)
+    def run(*args, **kwargs):
+        import profiling
+        with profiling.profiled(kwargs.get('profile')):
+            return command(*args, **kwargs)
+    return run
 
 
 def conf_callback(ctx: typer.Context, param: typer.CallbackParam, value: str):
     if value:
+        import yaml
         typer.echo(f"Loading config file: {value}")
         try:
             with open(value, 'r') as f:  # Load config file
@@ -35,102 +55,495 @@ def conf_callback(ctx: typer.Context, param: typer.CallbackParam, value: str):
 
 def open_json(loc: str):
     """
-    Open a json file and return the json object. Attempt to fix invalid json.
+    Open a json file and return the json object. Attempt to fix invalid json by
+    keeping the items that were written completely, in a single pass.
 
     :param loc:
     :return:
     """
-    res = {}
-    invalid_json = False
     with open(loc, "r") as f:
         txt = f.read()
+    try:
+        return json.loads(txt)
+    except JSONDecodeError:
+        print('Invalid json! Attempting to re-read')
+    res = read_json_items(txt)
+    print(f'Recovered {len(res)} items')
+    return res
+
+
+def import_sent_ads_json(ad_store: AdStore, fs, sent_ads_json_loc: str, sync_dropbox_locations: bool):
+    """
+    Import the legacy sent ads json file, downloaded from dropbox when syncing,
+    into an ad store that has no sent ads yet.
+    """
+    if sync_dropbox_locations:
+        log.info(f'Syncing dropbox locations with local passed locations {sent_ads_json_loc}')
+        try:
+            fs.download(SENT_ADS_JSON_LOC_DROPBOX, sent_ads_json_loc)
+        except Exception as ex:
+            log.error(f'Could not download json files {SENT_ADS_JSON_LOC_DROPBOX}'
+                      f' from dropbox')
+            log.exception(ex)
+    if os.path.exists(sent_ads_json_loc):
+        sent_ads = open_json(sent_ads_json_loc)
+        ad_store.import_ads(sent_ads, sent=True)
+        ad_store.commit()
+        log.info(f'Imported {len(sent_ads)} sent ads from {sent_ads_json_loc}')
+    else:
+        log.debug(f"Sent_ads file {sent_ads_json_loc} does not exist, starting with no sent ads")
+
+
+def open_ad_store(fs, ads_db_loc: str, sent_ads_json_loc: str, sync_dropbox_locations: bool,
+                  retention_days: int = 0):
+    """
+    Open the ad store and bring it up to date with its dropbox mirror.
+
+    :param retention_days: expire the ads first seen more than this many days
+        ago to tombstones, 0 keeps every ad whole
+
+    :return: the AdStore and the DeltaSync mirroring it to dropbox
+    """
+    from dropbox_sync import DeltaSync
+    ad_store = AdStore(ads_db_loc)
+    ad_sync = DeltaSync(fs, ad_store, AD_JOURNAL_DIR_DROPBOX)
+    if sync_dropbox_locations:
+        # Only the journal segments the local store doesn't have yet are downloaded
         try:
-            res = json.loads(txt)
-        except JSONDecodeError:
-            invalid_json = True
-            print('Invalid json! Attempting to re-read')
+            ad_sync.pull()
+        except Exception as ex:
+            log.error(f'Could not pull ad journal from {AD_JOURNAL_DIR_DROPBOX}')
+            log.exception(ex)
+    if ad_store.sent_count() == 0:
+        import_sent_ads_json(ad_store, fs, sent_ads_json_loc, sync_dropbox_locations)
+    if retention_days:
+        ad_store.expire(retention_days)
+        ad_store.commit()
+    return ad_store, ad_sync
 
-    if invalid_json:
-        for i in tqdm(range(len(txt), 0, -1)):
-            try:
-                res = json.loads(txt[:i] + '}')
-                break
-            except JSONDecodeError:
-                print('Unable to parse json at index', i)
 
-    return res
+def chat_routes(urls_to_scrape):
+    """
+    :return: dict of search url -> ids of the chats its ads go to, for the
+        searches of the scraper config with a chat_ids list
+    """
+    return {url_dict['url']: [str(chat_id) for chat_id in url_dict['chat_ids']]
+            for url_dict in urls_to_scrape if url_dict.get('chat_ids')}
+
+
+def image_processor(image_max_edge: int, image_format: str, image_quality: int):
+    """
+    :return: the ImageProcessor of the image options, None to store the images as they are
+    """
+    if not image_max_edge:
+        return None
+    from image_processing import ImageProcessor
+    return ImageProcessor(max_edge=image_max_edge, image_format=image_format, quality=image_quality)
+
+
+def send_new_ads(scraper: 'AdScraper', ad_store: AdStore):
+    """
+    Send the ads of the scraper that were not sent yet and upload their images.
+    Reposts of sent ads are only noted, their images are not uploaded.
+
+    :return: number of ads sent
+    """
+    import metrics
+    import profiling
+    n_sent = 0
+    for ad, is_sent in scraper.send_telegram_ads(scraper.ads.values()):
+        k = ad['Id']
+        if is_sent:
+            # If telegram message was sent , mark it as sent
+            with profiling.stage('persist'):
+                ad_store.mark_sent(k, ad)
+            n_sent += 1
+            metrics.ADS_SENT.inc()
+            with profiling.stage('persist'):
+                scraper.repost_index.add(k, ad)
+            if 'repost_of' not in ad:
+                scraper.save_ad_artefacts(ad=ad,
+                                          ad_id=k,
+                                          destination_folder=ARTEFACTS_DIR_DROPBOX,
+                                          fs=scraper.dropbox_fs)
+            log.info(f'Processed Ad {ad["Id"]}')
+        else:
+            log.info(f'Ad {ad["Id"]} was not sent, skipping for now')
+
+    delivered, failed = scraper.image_pipeline.wait()
+    scraper.artefacts.write_manifests(ARTEFACTS_DIR_DROPBOX, scraper.dropbox_fs)
+    # The bytes transferred and saved by this call only, the daemon and the
+    # pipeline call it on every tick or page
+    log.info(f'Stored {delivered} images, {failed} failed. '
+             f'{scraper.artefacts.summary(scraper.artefacts.take_stats())}')
+    return n_sent
 
 
 @app.command()
+@profiled
 def main(
         config: str = typer.Option("", callback=conf_callback, is_eager=True),
         dropbox_token: str = typer.Option("", envvar="DROPBOX_ACCESS_TOKEN"),
         telegram_token: str = typer.Option("", envvar="TELEGRAM_TOKEN"),
         telegram_chat_id: str = typer.Option("", envvar="TELEGRAM_CHAT_ID"),
-        all_ads_json_loc: str = typer.Option("/home/anton/.kijiji_scraper/config_ads.json"),
+        scraper_config: str = typer.Option("", help="Kijiji scraper config, the ads of its searches with chat_ids "
+                                                    "go to those chats instead of --telegram-chat-id"),
+        ads_db_loc: str = typer.Option("/home/anton/.kijiji_scraper/ads.db"),
         sent_ads_json_loc: str = typer.Option("/home/anton/.kijiji_scraper/sent_ads.json"),
         sync_dropbox_locations: bool = typer.Option(True, flag_value=True),
-        ignore_business_ads: bool = typer.Option(True, flag_value=True)):
+        ignore_business_ads: bool = typer.Option(True, flag_value=True),
+        digest_threshold: int = typer.Option(10, help="Send digest albums when more ads than this are waiting"),
+        reposts: str = typer.Option("note", help="What to send for a repost of a sent ad: the ad (send), a one "
+                                                 "line note (note) or nothing (suppress)"),
+        image_max_edge: int = typer.Option(0, help="Downscale the stored images to this many pixels on their "
+                                                   "longest edge and store thumbnails, 0 stores them as they are"),
+        image_format: str = typer.Option("jpeg", help="Format of the downscaled images: jpeg or webp"),
+        image_quality: int = typer.Option(80, help="Quality of the downscaled images, from 1 to 95"),
+        retention_days: int = typer.Option(0, help="Only keep the id and sent time of the ads first seen more "
+                                                   "than this many days ago, 0 keeps every ad"),
+        metrics_file: str = typer.Option("", help="Write Prometheus metrics of the run to this file, "
+                                                  "e.g. in the node exporter textfile collector directory"),
+        profile: str = typer.Option("", help="Profile the run and write the time of each stage to this report file")):
+    import metrics
+    import profiling
+    from adscraper import AdScraper, DropboxDriveFS
+    from http_cache import shared_cache
+    start = time.perf_counter()
+    if metrics_file:
+        metrics.enable()
+    metrics.watch_http_cache(shared_cache())
     dropbox_fs = DropboxDriveFS(token=dropbox_token,
                                 app_key=os.environ['APP_KEY'],
                                 refresh_token=os.environ['REFRESH_TOKEN'],
                                 app_secret=os.environ['APP_SECRET'])
-    if sync_dropbox_locations:
-        # We need to download the json files from dropbox and save into json_loc:
-        log.info(f'Syncing dropbox locations with local passed locations {sent_ads_json_loc}')
+    log.info(f'Running scraping with config: {config}')
+    routes = {}
+    if scraper_config:
+        import yaml
+        with open(scraper_config, 'r') as f:
+            _, urls_to_scrape = yaml.safe_load_all(f)
+        routes = chat_routes(urls_to_scrape or [])
+    ad_store, ad_sync = open_ad_store(dropbox_fs, ads_db_loc, sent_ads_json_loc, sync_dropbox_locations,
+                                      retention_days)
+    # initiate Ad scraper
+
+    scraper = AdScraper(ad_store=ad_store, dropbox_token=dropbox_token, telegram_token=telegram_token,
+                        telegram_chat_id=telegram_chat_id, ignore_business_ads=ignore_business_ads,
+                        digest_threshold=digest_threshold, reposts=reposts,
+                        image_processor=image_processor(image_max_edge, image_format, image_quality),
+                        chat_routes=routes)
+    if retention_days:
+        scraper.repost_index.expire(retention_days)
+
+    n_sent = send_new_ads(scraper, ad_store)
+    scraper.close()
+
+    # Update the ads mirrored in dropbox, nothing is uploaded if no ad changed
+    log.info(f'Sent {n_sent} ads, pushing ad journal to dropbox')
+    with profiling.stage('persist'):
+        ad_sync.push()
+
+    log.info(f'HTTP cache: {shared_cache().summary()}')
+    if metrics_file:
+        metrics.RUN_SECONDS.labels('notifier').set(time.perf_counter() - start)
+        metrics.write_textfile(metrics_file)
+    log.info('Done!')
+
+
+@app.command()
+@profiled
+def daemon(
+        config: str = typer.Option("", callback=conf_callback, is_eager=True),
+        scraper_config: str = typer.Option("scraper_config.yaml", help="Kijiji scraper config with the URLs to scrape"),
+        dropbox_token: str = typer.Option("", envvar="DROPBOX_ACCESS_TOKEN"),
+        telegram_token: str = typer.Option("", envvar="TELEGRAM_TOKEN"),
+        telegram_chat_id: str = typer.Option("", envvar="TELEGRAM_CHAT_ID"),
+        ads_db_loc: str = typer.Option("/home/anton/.kijiji_scraper/ads.db"),
+        sent_ads_json_loc: str = typer.Option("/home/anton/.kijiji_scraper/sent_ads.json"),
+        sync_dropbox_locations: bool = typer.Option(True, flag_value=True),
+        ignore_business_ads: bool = typer.Option(True, flag_value=True),
+        digest_threshold: int = typer.Option(10, help="Send digest albums when more ads than this are waiting"),
+        reposts: str = typer.Option("note", help="What to send for a repost of a sent ad: the ad (send), a one "
+                                                 "line note (note) or nothing (suppress)"),
+        image_max_edge: int = typer.Option(0, help="Downscale the stored images to this many pixels on their "
+                                                   "longest edge and store thumbnails, 0 stores them as they are"),
+        image_format: str = typer.Option("jpeg", help="Format of the downscaled images: jpeg or webp"),
+        image_quality: int = typer.Option(80, help="Quality of the downscaled images, from 1 to 95"),
+        retention_days: int = typer.Option(0, help="Only keep the id and sent time of the ads first seen more "
+                                                   "than this many days ago, 0 keeps every ad"),
+        interval: float = typer.Option(5, help="Minutes between two scrapes of a URL without an interval in the config"),
+        sync_interval: float = typer.Option(5, help="Minutes between two pushes of the ad journal to dropbox"),
+        adaptive: bool = typer.Option(False, help="Adapt the interval of each URL to how often it has new ads"),
+        min_interval: float = typer.Option(5, help="Shortest interval between two scrapes of a URL with --adaptive"),
+        max_interval: float = typer.Option(120, help="Longest interval between two scrapes of a URL with --adaptive"),
+        metrics_port: int = typer.Option(0, help="Serve Prometheus metrics on this port, 0 to not serve them"),
+        profile: str = typer.Option("", help="Profile the process and write the time of each stage to this "
+                                             "report file when it stops")):
+    """
+    Scrape and send the new ads in a single long-running process. Each URL of the
+    scraper config is scraped on its own interval (its "interval" key, in minutes)
+    and the new ads are sent right away, with the HTTP sessions, the ad store and
+    the dropbox and telegram clients kept open between runs. With --adaptive the
+    intervals follow the rate of new ads of each URL instead. Stops after the
+    running job on SIGTERM or SIGINT.
+    """
+    import yaml
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    import metrics
+    import profiling
+    from adscraper import AdScraper, DropboxDriveFS
+    from http_cache import shared_cache
+    from kijiji_scraper.kijiji_scraper import KijijiScraper
+    from poll_schedule import PollSchedule
+
+    with open(scraper_config, 'r') as f:
+        _, urls_to_scrape = yaml.safe_load_all(f)
+    if not urls_to_scrape:
+        raise typer.BadParameter(f'No URLs to scrape in {scraper_config}')
+    if metrics_port:
+        metrics.enable()
+
+    dropbox_fs = DropboxDriveFS(token=dropbox_token,
+                                app_key=os.environ['APP_KEY'],
+                                refresh_token=os.environ['REFRESH_TOKEN'],
+                                app_secret=os.environ['APP_SECRET'])
+    ad_store, ad_sync = open_ad_store(dropbox_fs, ads_db_loc, sent_ads_json_loc, sync_dropbox_locations,
+                                      retention_days)
+    kijiji = KijijiScraper(filename=None, ad_store=ad_store)
+    poll_schedule = PollSchedule(ad_store.filepath.with_suffix('.poll.json'), min_interval=min_interval,
+                                 max_interval=max_interval) if adaptive else None
+    scraper = AdScraper(ad_store=ad_store, dropbox_token=dropbox_token, telegram_token=telegram_token,
+                        telegram_chat_id=telegram_chat_id, ignore_business_ads=ignore_business_ads,
+                        digest_threshold=digest_threshold, reposts=reposts,
+                        image_processor=image_processor(image_max_edge, image_format, image_quality),
+                        chat_routes=chat_routes(urls_to_scrape))
+    if retention_days:
+        scraper.repost_index.expire(retention_days)
+
+    def scrape(url_dict, job_id):
+        url = url_dict['url']
         try:
-            # dropbox_fs.download(ALL_ADS_JSON_LOC_DROPBOX, all_ads_json_loc)
-            dropbox_fs.download(SENT_ADS_JSON_LOC_DROPBOX, sent_ads_json_loc)
+            kijiji.set_exclude_list([str(e) for e in url_dict.get('exclude', [])])
+            ads, _ = kijiji.scrape_kijiji_for_ads(url, url_dict.get('pages', 3),
+                                                  stop_after_known=url_dict.get('stop_after_known'))
+            kijiji.save_ads()
+            log.info(f'Found {len(ads)} new ads for {url}')
+            if poll_schedule:
+                minutes = poll_schedule.record(url, len(ads))
+                poll_schedule.save()
+                scheduler.reschedule_job(job_id, trigger='interval', minutes=minutes)
+                log.info(f'Next scrape of {url} in {minutes:.0f} minutes')
+            if ads:
+                scraper.refresh_ads()
+                n_sent = send_new_ads(scraper, ad_store)
+                log.info(f'Sent {n_sent} ads')
         except Exception as ex:
-            log.error(f'Could not download json files {SENT_ADS_JSON_LOC_DROPBOX}'
-                      f' from dropbox')
+            log.error(f'Scraping {url} failed, retrying on the next run')
             log.exception(ex)
 
-    log.info(f'Running scraping with config: {config}')
-    all_ads = open_json(all_ads_json_loc)
-    # Addd key as an ID field to the dict
-    for k, v in all_ads.items():
-        v['Id'] = k
-    if os.path.exists(sent_ads_json_loc):
-        sent_ads = open_json(sent_ads_json_loc)
-    else:
-        log.debug(f"Sent_ads file {sent_ads_json_loc} does not exist, will create it")
-        sent_ads = {}
-    # Addd key as an ID field to the dict
-    for k, v in sent_ads.items():
-        v['Id'] = k
-    # initiate Ad scraper
+    def push():
+        try:
+            with profiling.stage('persist'):
+                ad_sync.push()
+        except Exception as ex:
+            log.error(f'Could not push ad journal to {AD_JOURNAL_DIR_DROPBOX}')
+            log.exception(ex)
 
-    scraper = AdScraper(all_ads=all_ads, sent_ads=sent_ads, dropbox_token=dropbox_token, telegram_token=telegram_token,
-                        telegram_chat_id=telegram_chat_id, ignore_business_ads=ignore_business_ads)
+    def expire():
+        try:
+            ad_store.expire(retention_days)
+            ad_store.commit()
+            scraper.repost_index.expire(retention_days)
+        except Exception as ex:
+            log.error('Could not expire old ads')
+            log.exception(ex)
 
-    for k, ad in scraper.ads.items():
-        is_sent = scraper.send_telegram_ad(ad)
-        if is_sent:
-            # If telegram message was sent , add to sent_ads
-            scraper.sent_ads[ad['Id']] = ad
-            scraper.save_ad_artefacts(ad=ad,
-                                   ad_id=k,
-                                   destination_folder='/Data/kijiji_ads',
-                                   fs=scraper.dropbox_fs)
-            log.info(f'Processed Ad {ad["Id"]}')
-        else:
-            log.info(f'Ad {ad["Id"]} was not sent, skipping for now')
+    # A single worker runs the jobs one after the other, they share the scraper state.
+    # Only intervals are scheduled, UTC avoids depending on the local timezone setup
+    scheduler = BlockingScheduler(timezone='UTC', executors={'default': {'type': 'threadpool', 'max_workers': 1}},
+                                  job_defaults={'coalesce': True, 'max_instances': 1})
+    for i, url_dict in enumerate(urls_to_scrape):
+        url = url_dict['url']
+        # A URL can be listed more than once, e.g. with different exclude lists
+        job_id = f'{i}:{url}'
+        minutes = url_dict.get('interval', interval)
+        next_run = time.time()
+        if poll_schedule and poll_schedule.next_poll(url):
+            # Carry on with the interval of the previous runs
+            minutes = poll_schedule.interval(url)
+            next_run = max(next_run, poll_schedule.next_poll(url))
+        scheduler.add_job(scrape, 'interval', args=[url_dict, job_id], id=job_id, minutes=minutes,
+                          next_run_time=datetime.fromtimestamp(next_run).astimezone())
+        log.info(f'Scraping {url} every {minutes:.0f} minutes')
+    if sync_dropbox_locations:
+        scheduler.add_job(push, 'interval', minutes=sync_interval)
+    if retention_days:
+        scheduler.add_job(expire, 'interval', hours=24)
 
-    # Update sent ads:
-    fs = scraper.dropbox_fs
-    with open(sent_ads_json_loc, "w") as f:
-        json.dump(scraper.sent_ads, f)
-    log.info(f'Updating sent ads with {len(scraper.ads)} ads')
-    log.info(f'Updating Dropbox sent ads file with {len(scraper.ads)} ads')
+    def shutdown(signum, frame):
+        log.info(f'Received signal {signum}, stopping after the running job')
+        scheduler.shutdown(wait=True)
 
-    with fs.open(SENT_ADS_JSON_LOC_DROPBOX, mode='w') as f:
-        f.write(json.dumps(scraper.sent_ads))
-    log.info(f'Updating Dropbox all ads file')
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    scheduler.start()
 
-    with fs.open(ALL_ADS_JSON_LOC_DROPBOX, mode='w') as f:
-        f.write(json.dumps(all_ads))
+    scraper.close()
+    if sync_dropbox_locations:
+        push()
+    ad_store.close()
+    log.info(f'HTTP cache: {shared_cache().summary()}')
+    log.info('Done!')
+
+
+# End of the pages of the searches in the pipeline queue
+END_OF_CRAWL = None
+# Put in place of a page when the crawl of a search failed
+CRAWL_FAILED = object()
 
+
+def crawl_pages(kijiji, urls_to_scrape, pages_queue):
+    """
+    Put the result pages of every search on pages_queue as (url_dict, page) as
+    soon as each one is parsed, and (url_dict, None) after the last page of a
+    search, or (url_dict, CRAWL_FAILED) if its crawl failed. END_OF_CRAWL
+    follows the last search.
+    """
+    try:
+        for url_dict in urls_to_scrape:
+            try:
+                for page in kijiji.iter_pages(url_dict['url'], url_dict.get('pages', 3),
+                                              url_dict.get('stop_after_known')):
+                    pages_queue.put((url_dict, page))
+            except Exception as ex:
+                log.error(f'Crawling {url_dict["url"]} failed, retrying on the next run')
+                log.exception(ex)
+                pages_queue.put((url_dict, CRAWL_FAILED))
+            else:
+                pages_queue.put((url_dict, None))
+    finally:
+        pages_queue.put(END_OF_CRAWL)
+
+
+@app.command()
+@profiled
+def pipeline(
+        config: str = typer.Option("", callback=conf_callback, is_eager=True),
+        scraper_config: str = typer.Option("scraper_config.yaml", help="Kijiji scraper config with the URLs to scrape"),
+        dropbox_token: str = typer.Option("", envvar="DROPBOX_ACCESS_TOKEN"),
+        telegram_token: str = typer.Option("", envvar="TELEGRAM_TOKEN"),
+        telegram_chat_id: str = typer.Option("", envvar="TELEGRAM_CHAT_ID"),
+        ads_db_loc: str = typer.Option("/home/anton/.kijiji_scraper/ads.db"),
+        sent_ads_json_loc: str = typer.Option("/home/anton/.kijiji_scraper/sent_ads.json"),
+        sync_dropbox_locations: bool = typer.Option(True, flag_value=True),
+        ignore_business_ads: bool = typer.Option(True, flag_value=True),
+        digest_threshold: int = typer.Option(10, help="Send digest albums when more ads than this are waiting"),
+        reposts: str = typer.Option("note", help="What to send for a repost of a sent ad: the ad (send), a one "
+                                                 "line note (note) or nothing (suppress)"),
+        image_max_edge: int = typer.Option(0, help="Downscale the stored images to this many pixels on their "
+                                                   "longest edge and store thumbnails, 0 stores them as they are"),
+        image_format: str = typer.Option("jpeg", help="Format of the downscaled images: jpeg or webp"),
+        image_quality: int = typer.Option(80, help="Quality of the downscaled images, from 1 to 95"),
+        retention_days: int = typer.Option(0, help="Only keep the id and sent time of the ads first seen more "
+                                                   "than this many days ago, 0 keeps every ad"),
+        adaptive: bool = typer.Option(False, help="Only scrape the URLs that are due, on an interval adapted "
+                                                  "to how often each has new ads"),
+        min_interval: float = typer.Option(5, help="Shortest interval between two scrapes of a URL with --adaptive"),
+        max_interval: float = typer.Option(120, help="Longest interval between two scrapes of a URL with --adaptive"),
+        max_queued_pages: int = typer.Option(8, help="Parsed pages the crawl can get ahead of the sending"),
+        metrics_file: str = typer.Option("", help="Write Prometheus metrics of the run to this file, "
+                                                  "e.g. in the node exporter textfile collector directory"),
+        profile: str = typer.Option("", help="Profile the run and write the time of each stage to this report file")):
+    """
+    Scrape and send the new ads in one run, replacing the scraper run followed by
+    the main command. A background thread crawls the search pages while the new
+    ads of each parsed page are stored and sent right away, so the detail pages,
+    Telegram messages and image uploads of a page overlap with the crawl of the
+    next ones.
+    """
+    import queue
+    import threading
+    import yaml
+    import metrics
+    import profiling
+    from adscraper import AdScraper, DropboxDriveFS
+    from http_cache import shared_cache
+    from kijiji_scraper.kijiji_scraper import KijijiScraper
+    from poll_schedule import PollSchedule
+    start = time.perf_counter()
+
+    with open(scraper_config, 'r') as f:
+        _, urls_to_scrape = yaml.safe_load_all(f)
+    if not urls_to_scrape:
+        raise typer.BadParameter(f'No URLs to scrape in {scraper_config}')
+    if metrics_file:
+        metrics.enable()
+
+    dropbox_fs = DropboxDriveFS(token=dropbox_token,
+                                app_key=os.environ['APP_KEY'],
+                                refresh_token=os.environ['REFRESH_TOKEN'],
+                                app_secret=os.environ['APP_SECRET'])
+    ad_store, ad_sync = open_ad_store(dropbox_fs, ads_db_loc, sent_ads_json_loc, sync_dropbox_locations,
+                                      retention_days)
+    kijiji = KijijiScraper(filename=None, ad_store=ad_store)
+    poll_schedule = None
+    if adaptive:
+        poll_schedule = PollSchedule(ad_store.filepath.with_suffix('.poll.json'), min_interval=min_interval,
+                                     max_interval=max_interval)
+        urls_to_scrape = [url_dict for url_dict in urls_to_scrape if poll_schedule.is_due(url_dict['url'])]
+        log.info(f'Scraping {len(urls_to_scrape)} URLs, the others are not due yet')
+    scraper = AdScraper(ad_store=ad_store, dropbox_token=dropbox_token, telegram_token=telegram_token,
+                        telegram_chat_id=telegram_chat_id, ignore_business_ads=ignore_business_ads,
+                        digest_threshold=digest_threshold, reposts=reposts,
+                        image_processor=image_processor(image_max_edge, image_format, image_quality),
+                        chat_routes=chat_routes(urls_to_scrape))
+    if retention_days:
+        scraper.repost_index.expire(retention_days)
+
+    # Ads left unsent by a previous run go first
+    n_sent = send_new_ads(scraper, ad_store) if scraper.ads else 0
+
+    pages_queue = queue.Queue(maxsize=max_queued_pages)
+    crawler = threading.Thread(target=crawl_pages, args=(kijiji, urls_to_scrape, pages_queue),
+                               name='crawler', daemon=True)
+    crawler.start()
+    new_ads = {}
+    while True:
+        item = pages_queue.get()
+        if item is END_OF_CRAWL:
+            break
+        url_dict, page = item
+        url = url_dict['url']
+        if page is None or page is CRAWL_FAILED:
+            log.info(f'Found {new_ads.get(url, 0)} new ads for {url}')
+            # A failed search keeps its interval, it is due again on the next run
+            if poll_schedule and page is not CRAWL_FAILED:
+                minutes = poll_schedule.record(url, new_ads.get(url, 0))
+                log.info(f'Next scrape of {url} in {minutes:.0f} minutes')
+            continue
+        kijiji.set_exclude_list([str(e) for e in url_dict.get('exclude', [])])
+        ads = kijiji.scrape_page(page, url)
+        new_ads[url] = new_ads.get(url, 0) + len(ads)
+        kijiji.save_ads()
+        if ads:
+            scraper.refresh_ads()
+            n_sent += send_new_ads(scraper, ad_store)
+    crawler.join()
+
+    if poll_schedule:
+        poll_schedule.save()
+    log.info(f'Sent {n_sent} ads')
+    scraper.close()
+    if sync_dropbox_locations:
+        with profiling.stage('persist'):
+            ad_sync.push()
+    ad_store.close()
+    log.info(f'HTTP cache: {shared_cache().summary()}')
+    if metrics_file:
+        metrics.RUN_SECONDS.labels('pipeline').set(time.perf_counter() - start)
+        metrics.write_textfile(metrics_file)
     log.info('Done!')
 
 
@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger as log
+from telegram.error import RetryAfter
+
+import metrics
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket: holds up to capacity tokens, refilled at rate
+    tokens per second. acquire() blocks until enough tokens are available.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def empty(self):
+        # After a RetryAfter, start again from an empty bucket
+        with self.lock:
+            self.tokens = 0
+            self.updated = time.monotonic()
+
+
+# Telegram lets a bot send about 30 messages per second over all chats
+GLOBAL_BUCKET = TokenBucket(rate=30, capacity=30)
+
+
+class TelegramDispatcher:
+    """
+    Sends messages to one chat within Telegram's rate limits.
+
+    Every message of a media group takes a token from the chat's bucket (20
+    messages per minute in a group by default) and from the bot wide bucket.
+    When Telegram still answers with RetryAfter, the dispatcher waits for
+    retry_after seconds and sends the message again instead of dropping it.
+    """
+
+    def __init__(self, bot, chat_id, messages_per_minute=20, max_retries=5, global_bucket=GLOBAL_BUCKET):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.messages_per_minute = messages_per_minute
+        self.chat_bucket = TokenBucket(rate=messages_per_minute / 60, capacity=messages_per_minute)
+        self.global_bucket = global_bucket
+        self.max_retries = max_retries
+
+    def drain_time(self, n_messages):
+        """
+        :return: seconds needed to send n_messages once the chat bucket is empty
+        """
+        return max(0, n_messages - self.chat_bucket.capacity) * 60 / self.messages_per_minute
+
+    def send_media_group(self, media):
+        """
+        Send a media group, waiting for the rate limits and for RetryAfter.
+        Raises the last RetryAfter when it still fails after max_retries retries.
+        """
+        return self.__send(len(media), self.bot.send_media_group, media=media)
+
+    def send_message(self, text):
+        """
+        Send a text message, like send_media_group.
+        """
+        return self.__send(1, self.bot.send_message, text=text)
+
+    def __send(self, n_messages, send, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.chat_bucket.acquire(n_messages)
+            self.global_bucket.acquire(n_messages)
+            try:
+                return send(chat_id=self.chat_id, **kwargs)
+            except RetryAfter as e:
+                metrics.TELEGRAM_RETRY_AFTER.inc()
+                if attempt == self.max_retries:
+                    raise
+                log.warning(f"Telegram rate limit exceeded, retrying in {e.retry_after}s")
+                self.chat_bucket.empty()
+                time.sleep(e.retry_after)
+
+
+class ChatFanout:
+    """
+    Sends to several chats side by side. Every chat gets its own
+    TelegramDispatcher, with its own rate limit, and its own sending thread,
+    so the messages of a chat go out in the order they were submitted while a
+    chat that is slow, e.g. waiting out a RetryAfter, doesn't hold up the
+    others. The bot wide rate limit is still shared.
+    """
+
+    def __init__(self, bot, messages_per_minute=20):
+        self.bot = bot
+        self.messages_per_minute = messages_per_minute
+        self.dispatchers = {}
+        self.executors = {}
+        self.lock = threading.Lock()
+
+    def dispatcher(self, chat_id):
+        """
+        :return: the TelegramDispatcher of a chat, created on first use
+        """
+        with self.lock:
+            if chat_id not in self.dispatchers:
+                self.dispatchers[chat_id] = TelegramDispatcher(self.bot, chat_id, self.messages_per_minute)
+                self.executors[chat_id] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'chat{chat_id}')
+            return self.dispatchers[chat_id]
+
+    def submit(self, chat_id, send, *args):
+        """
+        Queue send(dispatcher, *args) on the thread of a chat, after the sends
+        queued for that chat before.
+
+        :return: future of the result of send
+        """
+        dispatcher = self.dispatcher(chat_id)
+        return self.executors[chat_id].submit(send, dispatcher, *args)
+
+    def close(self):
+        with self.lock:
+            executors, self.executors, self.dispatchers = self.executors, {}, {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)